@@ -0,0 +1,285 @@
+"""Tailor the resume to every job posting in a JSONL file, without the web app.
+
+    python batch.py postings.jsonl --output batch_output
+
+Each line of the input is a JSON object with `job_title` and `job_description`, and optionally `id`,
+`company` and `about`. Results for every posting are written to `<output>/<id>/` as soon as they are
+ready, and one line per finished posting is appended to `<output>/results.jsonl`. Running the same
+command again after a crash or Ctrl+C skips the postings that are already done.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os.path import dirname, join
+
+from dotenv import load_dotenv
+
+from cover_letter import render_pdf
+from generation import build_request, check_error, check_latex, compile_latex, generate_response
+from retry import routes_for
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+# requests per minute sent to each provider, across all postings
+BATCH_RATE_LIMIT = float(os.environ.get("BATCH_RATE_LIMIT", "50"))
+BATCH_COMPILE_WORKERS = int(os.environ.get("BATCH_COMPILE_WORKERS", str(os.cpu_count() or 1)))
+
+MANIFEST = "results.jsonl"
+
+
+class RateLimiter:
+    """Spaces out requests to each provider so that at most `per_minute` start in any minute."""
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute > 0 else 0
+        self._next = {}
+        self._locks = {}
+
+    async def acquire(self, provider):
+        if not self.interval:
+            return
+        lock = self._locks.setdefault(provider, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(provider, now))
+            self._next[provider] = start + self.interval
+        await asyncio.sleep(start - now)
+
+
+def posting_id(posting):
+    """A stable id for a posting, so a rerun can tell which ones are already done."""
+    if posting.get("id") not in (None, ""):
+        return re.sub(r"[^A-Za-z0-9._-]+", "_", str(posting["id"])).strip("._") or "posting"
+    digest = hashlib.sha256()
+    for field in ("company", "job_title", "job_description"):
+        digest.update(str(posting.get(field, "")).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def read_postings(path):
+    postings = []
+    with open(path, "r") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                posting = json.loads(line)
+            except ValueError as e:
+                raise SystemExit(f"{path}:{line_number}: not valid JSON ({e})")
+            if not posting.get("job_title") or not posting.get("job_description"):
+                raise SystemExit(f"{path}:{line_number}: job_title and job_description are required")
+            postings.append(posting)
+    return postings
+
+
+def read_done(output_dir):
+    """Ids of the postings already finished in an earlier run."""
+    done = set()
+    try:
+        with open(join(output_dir, MANIFEST), "r") as manifest:
+            for line in manifest:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may have been cut off by a crash
+                    continue
+                if entry.get("status") == "done":
+                    done.add(entry["id"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def write_file(path, data):
+    # write to a temporary name first, so a crash never leaves a half-written file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def safe_name(name):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name).strip("._") or "cover_letter"
+
+
+def compile_outputs(latex, cover_letter, name, posting_dir, issues=()):
+    """Compile the resume and render the cover letter into `posting_dir`. Runs in a worker process.
+
+    A resume with `issues` left by the LaTeX check isn't compiled. Failures, pdflatex missing included, end
+    up in the returned error rather than raising, since the model's response is already saved by then.
+    Returns `(files, compile_error, seconds)`.
+    """
+    started = time.perf_counter()
+    files = []
+    try:
+        pdf_path, error = (None, check_error(issues)) if issues else compile_latex(latex)
+    except Exception as e:
+        pdf_path, error = None, f"Couldn't compile the resume: {e!r}"
+    if error:
+        write_file(join(posting_dir, "resume.log"), error)
+        files.append("resume.log")
+    else:
+        shutil.copyfile(pdf_path, join(posting_dir, "resume.pdf.tmp"))
+        os.replace(join(posting_dir, "resume.pdf.tmp"), join(posting_dir, "resume.pdf"))
+        files.append("resume.pdf")
+    cover_letter_file = f"{safe_name(name)}.pdf"
+    try:
+        write_file(join(posting_dir, cover_letter_file), render_pdf(cover_letter))
+        files.append(cover_letter_file)
+    except Exception as e:
+        message = f"Couldn't render the cover letter: {e!r}"
+        write_file(join(posting_dir, "cover_letter.log"), message)
+        files.append("cover_letter.log")
+        error = f"{error}\n{message}" if error else message
+    return files, error, time.perf_counter() - started
+
+
+class BatchRunner:
+    def __init__(self, resume, output_dir, routes, api_keys, system_prompt, cover_letter_prompt, about_you="",
+                 mode="Full resume", concurrency=BATCH_CONCURRENCY, rate_limit=BATCH_RATE_LIMIT,
+                 compile_workers=BATCH_COMPILE_WORKERS):
+        self.resume = resume
+        self.output_dir = output_dir
+        self.routes = routes
+        self.api_keys = api_keys
+        self.system_prompt = system_prompt
+        self.cover_letter_prompt = cover_letter_prompt
+        self.about_you = about_you
+        self.mode = mode
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate_limit)
+        self.compile_workers = compile_workers
+        self.finished = 0
+        self.total = 0
+
+    async def run(self, postings):
+        """Tailor every posting that isn't done yet. Returns the number of postings that failed."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        done = read_done(self.output_dir)
+        pending = {}
+        for posting in postings:
+            pending.setdefault(posting_id(posting), posting)
+        pending = [(key, posting) for key, posting in pending.items() if key not in done]
+        self.total = len(pending)
+        if len(done):
+            log(f"Skipping {len(done)} postings finished in an earlier run")
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with open(join(self.output_dir, MANIFEST), "a") as manifest, \
+                ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as llm_threads, \
+                ProcessPoolExecutor(max_workers=self.compile_workers) as compile_processes:
+
+            async def tailor(key, posting):
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        entry = await self.tailor(loop, llm_threads, compile_processes, key, posting)
+                    except Exception as e:
+                        entry = {"id": key, "job_title": posting["job_title"], "company": posting.get("company"),
+                                 "status": "failed", "error": str(e),
+                                 "timings": {"total": time.perf_counter() - started}}
+                manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                self.finished += 1
+                summary = (f"done in {entry['timings']['total']:.1f}s" if entry["status"] == "done"
+                           else f"failed: {entry['error']}")
+                if entry.get("compile_error"):
+                    summary += f", but didn't compile (see {entry['dir']}/)"
+                log(f"[{self.finished}/{self.total}] {posting['job_title']}: {summary}")
+                return entry
+
+            entries = await asyncio.gather(*(tailor(key, posting) for key, posting in pending))
+        return sum(entry["status"] != "done" for entry in entries)
+
+    async def tailor(self, loop, llm_threads, compile_processes, key, posting):
+        started = time.perf_counter()
+        entry = {"id": key, "job_title": posting["job_title"], "company": posting.get("company")}
+        request = build_request(self.routes, self.api_keys, self.resume, posting["job_title"],
+                                posting["job_description"], posting.get("about", self.about_you),
+                                self.system_prompt, self.cover_letter_prompt, self.mode)
+
+        def throttle(route):
+            # called from the worker thread right before each request to the model
+            asyncio.run_coroutine_threadsafe(self.limiter.acquire(route.provider), loop).result()
+
+        def generate():
+            response, _ = generate_response(request, early_compile=False, throttle=throttle)
+            response["resume"], issues = check_latex(response["resume"], request.current_latex, request.routes,
+                                                     request.api_keys)
+            return response, issues
+
+        response, issues = await loop.run_in_executor(llm_threads, generate)
+        model_seconds = time.perf_counter() - started
+
+        posting_dir = join(self.output_dir, key)
+        os.makedirs(posting_dir, exist_ok=True)
+        write_file(join(posting_dir, "resume.tex"), response["resume"])
+        write_file(join(posting_dir, "cover_letter.txt"), response["cover_letter"])
+
+        compile_started = time.perf_counter()
+        try:
+            files, error, compile_seconds = await loop.run_in_executor(
+                compile_processes, compile_outputs, response["resume"], response["cover_letter"], response["name"],
+                posting_dir, issues)
+        except Exception as e:
+            # e.g. the worker process died; the response is on disk, so the posting doesn't count as failed
+            files, error, compile_seconds = [], repr(e), time.perf_counter() - compile_started
+        return {**entry, "status": "done", "name": response["name"], "dir": key,
+                "files": ["resume.tex", "cover_letter.txt", *files], "compile_error": bool(error),
+                "timings": {"model": model_seconds, "compile": compile_seconds,
+                            "total": time.perf_counter() - started}}
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    load_dotenv(join(dirname(__file__), '.env'))
+    parser = argparse.ArgumentParser(description="Tailor the resume and write a cover letter for every job "
+                                                 "posting in a JSONL file.")
+    parser.add_argument("postings", help="JSONL file with one job posting per line")
+    parser.add_argument("--output", default="batch_output", help="directory the results are written to")
+    parser.add_argument("--resume", default="resume.tex", help="LaTeX resume to tailor")
+    parser.add_argument("--provider", choices=["OpenAI", "Claude"], default="OpenAI")
+    parser.add_argument("--model", default=None, help="defaults to gpt-4o or claude-3-5-sonnet-20240620")
+    parser.add_argument("--mode", choices=["Full resume", "Section edits"], default="Full resume")
+    parser.add_argument("--about", default="", help="'About You' text for postings that don't have their own")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help="postings tailored at the same time")
+    parser.add_argument("--rate-limit", type=float, default=BATCH_RATE_LIMIT,
+                        help="requests per minute to each provider (0 for no limit)")
+    parser.add_argument("--compile-workers", type=int, default=BATCH_COMPILE_WORKERS)
+    args = parser.parse_args(argv)
+
+    with open(args.resume, "r") as file:
+        resume = file.read()
+    model = args.model or ("gpt-4o" if args.provider == "OpenAI" else "claude-3-5-sonnet-20240620")
+    runner = BatchRunner(
+        resume=resume,
+        output_dir=args.output,
+        routes=routes_for(args.provider, model),
+        api_keys={"OpenAI": os.environ.get("OPENAI_API_KEY"), "Claude": os.environ.get("ANTHROPIC_API_KEY")},
+        system_prompt=os.environ.get("INITIAL_SYSTEM_PROMPT", ""),
+        cover_letter_prompt=os.environ.get("INITIAL_COVER_LETTER_PROMPT", ""),
+        about_you=args.about,
+        mode=args.mode,
+        concurrency=args.concurrency,
+        rate_limit=args.rate_limit,
+        compile_workers=args.compile_workers,
+    )
+    failed = asyncio.run(runner.run(read_postings(args.postings)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
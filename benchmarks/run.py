@@ -0,0 +1,236 @@
+"""Offline benchmarks for the compile, parse, render and generation paths.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --baseline bench.json --tolerance 0.2
+
+Model calls go to a local stub server (benchmarks/stub_llm.py), so nothing is billed. Results are
+written as JSON; with `--baseline` every timing is compared to an earlier run and the command exits
+with status 1 if any got worse by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.stub_llm import StubServer
+from benchmarks.synthetic import model_response, synthetic_posting, synthetic_resume
+
+RESUME_SIZES = {"small": 4, "medium": 12, "large": 40, "xl": 120}
+SESSION_COUNTS = (1, 8, 32)
+RESPONSE_STYLES = ("clean", "latex", "fenced", "truncated")
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    ordered = sorted(samples)
+    return {"n": len(ordered),
+            "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+            "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def bench_validate_json(repeat):
+    from generation import validate_json
+
+    results = {}
+    for size, entries in RESUME_SIZES.items():
+        resume = synthetic_resume(entries, seed=entries)
+        for style in RESPONSE_STYLES:
+            text = model_response(resume, style)
+            samples = []
+            for _ in range(repeat):
+                seconds, _ = timed(validate_json, text)
+                samples.append(seconds)
+            results[f"{size}/{style}"] = {**summarize(samples), "bytes": len(text)}
+    return results
+
+
+def bench_cover_letter_pdf(repeat):
+    from cover_letter import render_pdf
+    from benchmarks.synthetic import synthetic_cover_letter
+
+    results = {}
+    for paragraphs in (2, 4, 8):
+        text = synthetic_cover_letter(paragraphs)
+        render_pdf.cache_clear()
+        samples = []
+        for _ in range(repeat):
+            render_pdf.cache_clear()
+            seconds, _ = timed(render_pdf, text)
+            samples.append(seconds)
+        cached, _ = timed(render_pdf, text)
+        results[f"{paragraphs}_paragraphs"] = {**summarize(samples), "cached_ms": round(cached * 1000, 4)}
+    return results
+
+
+def bench_compile(repeat, workers):
+    from latex_compiler import LATEX_ENGINE
+    from generation import compile_latex
+
+    if shutil.which(LATEX_ENGINE) is None:
+        return {"skipped": f"{LATEX_ENGINE} not found"}
+    results = {}
+    for size, entries in RESUME_SIZES.items():
+        resume = synthetic_resume(entries, seed=entries)
+        # a unique comment per compile keeps the PDF cache out of the cold numbers
+        sources = [f"{resume}% benchmark {time.time_ns()} {index}\n" for index in range(repeat)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(lambda source: timed(compile_latex, source), sources))
+        wall = time.perf_counter() - started
+        failures = sum(1 for _, (_, error) in outcomes if error)
+        cached, _ = timed(compile_latex, sources[0])
+        results[size] = {**summarize([seconds for seconds, _ in outcomes]),
+                         "compiles_per_s": round(len(sources) / wall, 3), "failures": failures,
+                         "cached_ms": round(cached * 1000, 3)}
+    return results
+
+
+def bench_end_to_end(provider, model, sessions_list, requests_per_session, resume_size):
+    from latex_compiler import LATEX_ENGINE
+    from generation import build_request, generate_response, run_generation
+    from retry import Route
+
+    compile_too = shutil.which(LATEX_ENGINE) is not None
+    resume = synthetic_resume(RESUME_SIZES[resume_size], seed=7)
+    api_keys = {"OpenAI": "benchmark", "Claude": "benchmark"}
+
+    def one_request(index):
+        posting = synthetic_posting(index)
+        # a unique 'about' keeps the response cache from answering
+        request = build_request([Route(provider, model)], api_keys, resume, posting["job_title"],
+                                posting["job_description"], f"benchmark request {time.time_ns()} {index}",
+                                "Keep it to one page.", "Keep it short.")
+        if compile_too:
+            return timed(run_generation, request)
+        return timed(generate_response, request)
+
+    results = {"resume_size": resume_size, "compile": compile_too}
+    for sessions in sessions_list:
+        total = sessions * requests_per_session
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            outcomes = list(executor.map(one_request, range(total)))
+        wall = time.perf_counter() - started
+        results[f"{sessions}_sessions"] = {**summarize([seconds for seconds, _ in outcomes]),
+                                           "requests_per_s": round(total / wall, 3)}
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "commit": commit or None, "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+
+def regressions(results, baseline, tolerance):
+    """Timings (`*_ms`) that grew and rates (`*_per_s`) that dropped by more than `tolerance`."""
+    found = []
+
+    def walk(current, previous, path):
+        for key, value in current.items():
+            if key not in previous:
+                continue
+            if isinstance(value, dict) and isinstance(previous[key], dict):
+                walk(value, previous[key], f"{path}/{key}")
+            elif isinstance(value, (int, float)) and isinstance(previous[key], (int, float)) and previous[key] > 0:
+                change = (value - previous[key]) / previous[key]
+                if (key.endswith("_ms") and key != "max_ms" and change > tolerance) or \
+                        (key.endswith("_per_s") and -change > tolerance):
+                    found.append({"metric": f"{path}/{key}", "baseline": previous[key], "current": value,
+                                  "change": round(change, 3)})
+
+    walk(results["scenarios"], baseline.get("scenarios", {}), "")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks.")
+    parser.add_argument("--scenarios", default="validate_json,cover_letter_pdf,compile,end_to_end",
+                        help="comma separated subset to run")
+    parser.add_argument("--output", help="write the results to this file as well as stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before failing, 0.2 = 20%%")
+    parser.add_argument("--repeat", type=int, default=20, help="samples per micro benchmark")
+    parser.add_argument("--compile-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--sessions", default=",".join(map(str, SESSION_COUNTS)))
+    parser.add_argument("--requests-per-session", type=int, default=2)
+    parser.add_argument("--resume-size", choices=RESUME_SIZES, default="medium")
+    parser.add_argument("--provider", choices=["OpenAI", "Claude"], default="OpenAI")
+    parser.add_argument("--first-token", type=float, default=0.2, help="stub server delay before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=2000, help="stub server streaming rate")
+    args = parser.parse_args(argv)
+
+    stub = StubServer(0, args.first_token, args.tokens_per_second).start()
+    scratch = tempfile.mkdtemp(prefix="resume-benchmark-")
+    # set before the app modules are imported, since they read their settings at import time
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{stub.port}/v1",
+        "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{stub.port}",
+        "LLM_FALLBACK_ROUTES": "",
+        "LLM_RESPONSE_CACHE_SIZE": "0",
+        "PDF_CACHE_DIR": os.path.join(scratch, "pdf"),
+        "METRICS_TRACE_FILE": "",
+        "COMPILE_WORKERS": str(args.compile_workers),
+    })
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    model = "gpt-4o" if args.provider == "OpenAI" else "claude-3-5-sonnet-20240620"
+    results = {"environment": environment(), "settings": vars(args), "scenarios": {}}
+    try:
+        for name in scenarios:
+            print(f"Running {name}...", file=sys.stderr, flush=True)
+            if name == "validate_json":
+                results["scenarios"][name] = bench_validate_json(args.repeat)
+            elif name == "cover_letter_pdf":
+                results["scenarios"][name] = bench_cover_letter_pdf(args.repeat)
+            elif name == "compile":
+                results["scenarios"][name] = bench_compile(args.repeat, args.compile_workers)
+            elif name == "end_to_end":
+                sessions = [int(count) for count in args.sessions.split(",")]
+                results["scenarios"][name] = bench_end_to_end(args.provider, model, sessions,
+                                                              args.requests_per_session, args.resume_size)
+            else:
+                parser.error(f"unknown scenario: {name}")
+        results["stub_requests"] = stub.requests
+    finally:
+        stub.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    failed = []
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            failed = regressions(results, json.load(baseline_file), args.tolerance)
+        results["regressions"] = failed
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    for regression in failed:
+        print(f"Regression: {regression['metric']} {regression['baseline']} -> {regression['current']}",
+              file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
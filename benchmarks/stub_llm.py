@@ -0,0 +1,225 @@
+"""A local stand-in for the OpenAI and Anthropic APIs, for benchmarking without paying for real calls.
+
+    python -m benchmarks.stub_llm --port 8600 --first-token 0.5 --tokens-per-second 80
+
+then point the app at it with OPENAI_BASE_URL=http://localhost:8600/v1 and
+ANTHROPIC_BASE_URL=http://localhost:8600. Generation requests get the resume from the prompt back
+unchanged plus a synthetic cover letter, chat requests a reply, anything else a short summary. Both
+streaming and non-streaming responses are supported, with a configurable delay before the first token
+and a steady token rate after it.
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.synthetic import synthetic_cover_letter
+
+# characters per token the stub bills and streams at
+CHARS_PER_TOKEN = 4
+# tokens sent per streamed event
+TOKENS_PER_EVENT = 4
+
+_RESUME = re.compile(r"Resume: (.*?) \nCover Letter Instructions:", re.S)
+
+
+def request_texts(body):
+    """Every text block of a chat completions or messages request body, system prompt first."""
+    texts = []
+    system = body.get("system")
+    if isinstance(system, str):
+        texts.append(system)
+    elif isinstance(system, list):
+        texts.extend(block.get("text", "") for block in system)
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(block.get("text", "") for block in content or [])
+    return texts
+
+
+def completion_text(body):
+    texts = request_texts(body)
+    prompt = "\n".join(texts)
+    if "'edits' key" in prompt:
+        return json.dumps({"edits": [], "cover_letter": synthetic_cover_letter(), "name": "coverLetterBenchmark"})
+    if "'resume' key" in prompt:
+        match = _RESUME.search(prompt)
+        return json.dumps({"resume": match.group(1) if match else "", "cover_letter": synthetic_cover_letter(),
+                           "name": "coverLetterBenchmark"})
+    if "'reply' key" in prompt:
+        return json.dumps({"reply": "Done, I made it shorter.", "cover_letter": synthetic_cover_letter(),
+                           "name": "coverLetterBenchmark"})
+    return "The user asked for a shorter, less formal cover letter that mentions their open source work."
+
+
+def tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/chat/completions"):
+            self.server.count(body.get("model"))
+            self._openai(body)
+        elif path.endswith("/messages"):
+            self.server.count(body.get("model"))
+            self._anthropic(body)
+        else:
+            self.send_error(404)
+
+    def _pieces(self, text):
+        size = CHARS_PER_TOKEN * TOKENS_PER_EVENT
+        for index in range(0, len(text), size):
+            yield text[index:index + size]
+
+    def _wait_first_token(self):
+        time.sleep(self.server.first_token)
+
+    def _pace(self):
+        if self.server.tokens_per_second > 0:
+            time.sleep(TOKENS_PER_EVENT / self.server.tokens_per_second)
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _event(self, payload, name=None):
+        data = (f"event: {name}\n" if name else "") + f"data: {payload}\n\n"
+        data = data.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_events(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _openai(self, body):
+        text = completion_text(body)
+        usage = {"prompt_tokens": tokens("".join(request_texts(body))), "completion_tokens": tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        self._wait_first_token()
+        if not body.get("stream"):
+            time.sleep(usage["completion_tokens"] / self.server.tokens_per_second
+                       if self.server.tokens_per_second > 0 else 0)
+            self._send_json({"id": completion_id, "object": "chat.completion", "created": created,
+                             "model": body.get("model"), "usage": usage,
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": text}}]})
+            return
+
+        def chunk(delta, finish_reason=None, **extra):
+            choices = [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else []
+            return json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                               "model": body.get("model"), "choices": choices, **extra})
+
+        self._start_events()
+        self._event(chunk({"role": "assistant", "content": ""}))
+        for piece in self._pieces(text):
+            self._event(chunk({"content": piece}))
+            self._pace()
+        self._event(chunk({}, "stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._event(chunk(None, usage=usage))
+        self._event("[DONE]")
+        self._end_events()
+
+    def _anthropic(self, body):
+        text = completion_text(body)
+        usage = {"input_tokens": tokens("".join(request_texts(body))), "output_tokens": tokens(text)}
+        message = {"id": f"msg_{uuid.uuid4().hex[:12]}", "type": "message", "role": "assistant",
+                   "model": body.get("model"), "stop_reason": None, "stop_sequence": None}
+        self._wait_first_token()
+        if not body.get("stream"):
+            time.sleep(usage["output_tokens"] / self.server.tokens_per_second
+                       if self.server.tokens_per_second > 0 else 0)
+            self._send_json({**message, "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                             "usage": usage})
+            return
+
+        self._start_events()
+        self._event(json.dumps({"type": "message_start", "message": {
+            **message, "content": [], "usage": {"input_tokens": usage["input_tokens"], "output_tokens": 1}}}),
+            "message_start")
+        self._event(json.dumps({"type": "content_block_start", "index": 0,
+                                "content_block": {"type": "text", "text": ""}}), "content_block_start")
+        for piece in self._pieces(text):
+            self._event(json.dumps({"type": "content_block_delta", "index": 0,
+                                    "delta": {"type": "text_delta", "text": piece}}), "content_block_delta")
+            self._pace()
+        self._event(json.dumps({"type": "content_block_stop", "index": 0}), "content_block_stop")
+        self._event(json.dumps({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": usage["output_tokens"]}}), "message_delta")
+        self._event(json.dumps({"type": "message_stop"}), "message_stop")
+        self._end_events()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, first_token=0.2, tokens_per_second=2000):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.first_token = first_token
+        self.tokens_per_second = tokens_per_second
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, model):
+        with self._lock:
+            self.requests[model] = self.requests.get(model, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="stub-llm", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fake OpenAI and Anthropic responses locally.")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--first-token", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=2000, help="0 sends everything at once")
+    args = parser.parse_args()
+    server = StubServer(args.port, args.first_token, args.tokens_per_second)
+    print(f"Stub LLM server on http://127.0.0.1:{server.port} "
+          f"(OPENAI_BASE_URL=http://127.0.0.1:{server.port}/v1, ANTHROPIC_BASE_URL=http://127.0.0.1:{server.port})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Synthetic resumes, job postings and model responses for the benchmarks."""
+import json
+import random
+
+SKILLS = ["Python", "Go", "Kubernetes", "React", "TypeScript", "SQL", "PostgreSQL", "AWS", "Docker", "Kafka",
+          "Spark", "PyTorch", "Java", "Spring", "Terraform", "Redis", "GraphQL", "Rust", "Airflow", "Snowflake"]
+VERBS = ["Built", "Designed", "Led", "Migrated", "Optimized", "Automated", "Shipped", "Scaled", "Rewrote", "Owned"]
+THINGS = ["a billing pipeline", "the search service", "an internal developer portal", "a feature store",
+          "the mobile API", "a fraud detection model", "the data warehouse", "a real-time dashboard"]
+
+PREAMBLE = r"""\documentclass[letterpaper,11pt]{article}
+\usepackage[empty]{fullpage}
+\usepackage{titlesec}
+\usepackage[hidelinks]{hyperref}
+\usepackage{enumitem}
+\pagestyle{empty}
+\titleformat{\section}{\scshape\raggedright\large}{}{0em}{}[\titlerule]
+\newcommand{\resumeItem}[1]{\item\small{#1}}
+\newcommand{\resumeSubheading}[4]{\item\textbf{#1} \hfill #2 \\ \textit{#3} \hfill \textit{#4}}
+\newcommand{\resumeProjectHeading}[2]{\item #1 \hfill #2}
+\newcommand{\resumeSubHeadingListStart}{\begin{itemize}[leftmargin=0.15in, label={}]}
+\newcommand{\resumeSubHeadingListEnd}{\end{itemize}}
+\newcommand{\resumeItemListStart}{\begin{itemize}}
+\newcommand{\resumeItemListEnd}{\end{itemize}}
+"""
+
+
+def _bullet(rng):
+    skills = rng.sample(SKILLS, 2)
+    return (f"\\resumeItem{{{rng.choice(VERBS)} {rng.choice(THINGS)} with \\textbf{{{skills[0]}}} and "
+            f"{skills[1]}, cutting latency by {rng.randint(10, 90)}\\% for {rng.randint(2, 500)}k users}}\n")
+
+
+def synthetic_resume(entries, seed=0):
+    """A resume in the usual template with `entries` jobs and projects of three bullets each."""
+    rng = random.Random(seed)
+    parts = [PREAMBLE, "\\begin{document}\n",
+             "\\begin{center}\\textbf{\\Huge Jane Doe} \\\\ jane@example.com $|$ github.com/jane\\end{center}\n",
+             "\\section{Education}\n\\resumeSubHeadingListStart\n"
+             "\\resumeSubheading{State University}{2012 -- 2016}{B.S. Computer Science}{Springfield}\n"
+             "\\resumeSubHeadingListEnd\n"]
+    jobs = entries - entries // 3
+    parts.append("\\section{Experience}\n\\resumeSubHeadingListStart\n")
+    for index in range(jobs):
+        parts.append(f"\\resumeSubheading{{Company {index}}}{{20{10 + index % 14} -- Present}}"
+                     f"{{Software Engineer}}{{Remote}}\n\\resumeItemListStart\n")
+        parts.extend(_bullet(rng) for _ in range(3))
+        parts.append("\\resumeItemListEnd\n")
+    parts.append("\\resumeSubHeadingListEnd\n")
+    if entries - jobs:
+        parts.append("\\section{Projects}\n\\resumeSubHeadingListStart\n")
+        for index in range(entries - jobs):
+            parts.append(f"\\resumeProjectHeading{{\\textbf{{Project {index}}} $|$ "
+                         f"\\emph{{{', '.join(rng.sample(SKILLS, 3))}}}}}{{2021}}\n\\resumeItemListStart\n")
+            parts.extend(_bullet(rng) for _ in range(3))
+            parts.append("\\resumeItemListEnd\n")
+        parts.append("\\resumeSubHeadingListEnd\n")
+    parts.append("\\section{Technical Skills}\n\\begin{itemize}[leftmargin=0.15in, label={}]\n"
+                 f"\\item \\textbf{{Languages}}: {', '.join(SKILLS[:8])}\n\\end{{itemize}}\n\\end{{document}}\n")
+    return "".join(parts)
+
+
+def synthetic_posting(seed=0):
+    rng = random.Random(seed)
+    skills = rng.sample(SKILLS, 5)
+    title = f"{rng.choice(['Senior', 'Staff', ''])} {rng.choice(['Backend', 'Platform', 'Data'])} Engineer".strip()
+    description = (f"We are hiring a {title} to work on {rng.choice(THINGS)}. You have production experience "
+                   f"with {', '.join(skills[:3])} and ideally {skills[3]} or {skills[4]}. " * 4)
+    return {"job_title": title, "job_description": description, "company": f"Company {seed}"}
+
+
+def synthetic_cover_letter(paragraphs=4):
+    paragraph = ("I am excited to apply for this role. Over the past years I have built and scaled backend "
+                 "systems, mentored engineers and shipped features that customers rely on every day. ")
+    return "Dear Hiring Manager,\n\n" + "\n\n".join(paragraph * 3 for _ in range(paragraphs)) + "\n\nThanks,\nJane"
+
+
+def model_response(resume, style="clean"):
+    """A generation response in one of the shapes models actually send.
+
+    `clean` is valid JSON, `latex` has LaTeX commands with single backslashes, `fenced` is wrapped in
+    prose and a code fence, and `truncated` stops before the end of the object.
+    """
+    text = json.dumps({"resume": resume, "cover_letter": synthetic_cover_letter(), "name": "coverLetterJaneDoe"})
+    if style == "latex":
+        return text.replace("\\\\", "\\")
+    if style == "fenced":
+        return f"Here is the tailored resume:\n```json\n{text}\n```\nLet me know if you want changes."
+    if style == "truncated":
+        return text[:int(len(text) * 0.9)]
+    return text
@@ -0,0 +1,131 @@
+import contextvars
+import math
+import os
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from generation import GENERATION_TEMPERATURE, Cancelled, run_generation
+from jobs import Job
+from latex_compiler import pdf_page_count, split_preamble
+from resume_prune import tokenize
+from retry import Route
+
+# models and temperatures to generate candidates with, as provider:model@temperature
+GENERATION_CANDIDATES = os.environ.get(
+    "GENERATION_CANDIDATES",
+    "Claude:claude-3-5-sonnet-20240620@0.3,Claude:claude-3-haiku-20240307@0.7,OpenAI:gpt-4o-mini@0.7")
+# resumes longer than this many pages score lower
+CANDIDATE_MAX_PAGES = int(os.environ.get("CANDIDATE_MAX_PAGES", "1"))
+
+# how much each part counts towards a candidate's score
+COVERAGE_WEIGHT = 1.0
+PAGES_WEIGHT = 0.5
+COMPILED_WEIGHT = 2.0
+
+STOPWORDS = frozenset("""
+a about above after all also an and any are as at be been being both but by can could do does for from had has have
+having he her his how i if in into is it its may more most must of on or other our out over own same she should so
+some such than that the their them then there these they this those through to too under up very was we were what
+when where which while who will with within without would you your able etc e.g i.e work working team teams role
+experience years year strong ability skills including well new plus join looking ideal candidate responsibilities
+requirements required preferred qualifications across help using use based
+""".split())
+
+CandidateSpec = namedtuple("CandidateSpec", ["route", "temperature"])
+
+
+def parse_candidates(value=GENERATION_CANDIDATES):
+    """The `CandidateSpec`s of a `provider:model@temperature,...` list; the temperature may be left out."""
+    specs = []
+    for entry in value.split(","):
+        if ":" not in entry:
+            continue
+        route, _, temperature = entry.partition("@")
+        provider, model = (part.strip() for part in route.split(":", 1))
+        specs.append(CandidateSpec(Route(provider, model), float(temperature) if temperature.strip() else None))
+    return specs
+
+
+def job_keywords(job_description):
+    """The words of a job description worth finding in the resume, with how often the posting uses them."""
+    return Counter(word for word in tokenize(job_description)
+                   if word not in STOPWORDS and len(word) > 1 and not word.isdigit())
+
+
+def keyword_coverage(texts, job_description):
+    """The share of the posting's keywords, weighted by how often it uses them, found in each of `texts`."""
+    keywords = job_keywords(job_description)
+    if not keywords:
+        return np.zeros(len(texts))
+    vocabulary = {word: index for index, word in enumerate(keywords)}
+    weights = np.fromiter(keywords.values(), dtype=np.float32, count=len(keywords))
+    present = np.zeros((len(texts), len(vocabulary)), dtype=np.float32)
+    for row, text in enumerate(texts):
+        columns = [vocabulary[word] for word in set(tokenize(text)) if word in vocabulary]
+        present[row, columns] = 1
+    return present @ weights / weights.sum()
+
+
+def score_candidates(results, job_description, max_pages=CANDIDATE_MAX_PAGES):
+    """Score generation results on keyword coverage, page count and whether they compiled.
+
+    Adds `coverage`, `pages` and `score` to each result and returns them best first.
+    """
+    if not results:
+        return []
+    bodies = [(split_preamble(result["resume"]) or ("", result["resume"]))[1] for result in results]
+    coverage = keyword_coverage(bodies, job_description)
+    compiled = np.array([result["pdf_path"] is not None for result in results], dtype=np.float32)
+    pages = np.array([pdf_page_count(result["pdf_path"]) or math.nan if result["pdf_path"] else math.nan
+                      for result in results], dtype=np.float32)
+    # full marks up to the page limit, then proportionally less; nothing when the page count is unknown
+    fits = np.nan_to_num(np.minimum(1.0, max_pages / pages), nan=0.0)
+    scores = COVERAGE_WEIGHT * coverage + PAGES_WEIGHT * fits + COMPILED_WEIGHT * compiled
+
+    for result, result_coverage, result_pages, score in zip(results, coverage, pages, scores):
+        result["coverage"] = round(float(result_coverage), 3)
+        result["pages"] = None if math.isnan(result_pages) else int(result_pages)
+        result["score"] = round(float(score), 3)
+    return [results[index] for index in np.argsort(-scores, kind="stable")]
+
+
+def run_candidates(request, job_description, specs, job=None):
+    """Generate one tailored resume per `CandidateSpec` at the same time and rank them.
+
+    Every candidate is generated, checked and compiled like a single generation, so the whole thing
+    takes about as long as the slowest of them. Returns the best result with all of them, best first,
+    under `candidates`; raises the first error when none succeeded.
+    """
+    specs = [spec if spec.temperature is not None else spec._replace(
+        temperature=GENERATION_TEMPERATURE[spec.route.provider]) for spec in specs]
+
+    def generate(spec, part):
+        result = run_generation(request._replace(routes=[spec.route], temperature=spec.temperature), part)
+        return {**result, "route": spec.route, "temperature": spec.temperature}
+
+    parts = [Job(f"{spec.route.model} @ {spec.temperature}", job) for spec in specs]
+    if job is not None:
+        job.stage = "calling model"
+    results = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(specs), thread_name_prefix="candidate") as executor:
+        # each candidate runs in a copy of this context, so its spans and counters go to the caller's trace
+        futures = [executor.submit(contextvars.copy_context().run, generate, spec, part)
+                   for spec, part in zip(specs, parts)]
+        for part, future in zip(parts, futures):
+            try:
+                results.append(future.result())
+            except Cancelled:
+                raise
+            except Exception as e:
+                errors.append(e)
+                part.log(f"Failed: {e}")
+    if job is not None and job.cancelled:
+        raise Cancelled()
+    if not results:
+        raise errors[0]
+
+    ranked = score_candidates(results, job_description)
+    return {**ranked[0], "candidates": ranked}
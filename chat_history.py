@@ -0,0 +1,110 @@
+import os
+
+from llm import count_tokens, get_client, record_claude_usage, record_openai_usage
+from metrics import span
+from retry import RetryError, call_with_retry
+
+# tokens of past chat turns sent with each new message; older turns are folded into a summary
+CHAT_HISTORY_TOKENS = int(os.environ.get("CHAT_HISTORY_TOKENS", "2000"))
+CHAT_SUMMARY_TOKENS = int(os.environ.get("CHAT_SUMMARY_TOKENS", "400"))
+
+SUMMARY_PROMPT = ("You summarize a conversation between a user and an assistant who is writing the user's cover "
+                  "letter. Keep every request, preference and fact the user gave about themselves or the letter, "
+                  "and what was changed in response. Leave out the letter text itself. Answer with the summary "
+                  "only, in plain text.")
+
+
+def text_message(role, text):
+    return {"role": role, "content": [{"type": "text", "text": text}]}
+
+
+def message_text(message):
+    return "\n".join(block["text"] for block in message["content"] if block.get("type") == "text")
+
+
+def summarize_turns(routes, api_keys, summary, messages):
+    """Fold `messages` into the running `summary` of the conversation with one model call."""
+    transcript = "\n\n".join(f"{message['role']}: {message_text(message)}" for message in messages)
+    request = (f"Summary so far:\n{summary or '(none)'}\n\n"
+               f"Conversation to add to it:\n{transcript}")
+
+    def attempt(route):
+        client = get_client(route.provider, api_keys[route.provider])
+        if route.provider == "OpenAI":
+            completion = client.chat.completions.create(
+                model=route.model,
+                messages=[text_message("system", SUMMARY_PROMPT), text_message("user", request)],
+                max_tokens=CHAT_SUMMARY_TOKENS
+            )
+            record_openai_usage(route.model, completion.usage)
+            return completion.choices[0].message.content.strip()
+        message = client.messages.create(
+            system=SUMMARY_PROMPT,
+            messages=[text_message("user", request)],
+            model=route.model,
+            max_tokens=CHAT_SUMMARY_TOKENS
+        )
+        record_claude_usage(route.model, message.usage)
+        return message.content[0].text.strip()
+
+    with span("summarize_chat"):
+        _, result = call_with_retry(routes, attempt, task="summary")
+    return result
+
+
+class ChatHistory:
+    """The cover letter chat of one session: every turn for display, and a bounded prompt to send.
+
+    `messages` alternates user and assistant messages and is never trimmed, so the whole conversation
+    stays on screen. What goes to the model is the newest turns that fit the token budget, preceded
+    by a rolling summary of everything older, so a turn costs about the same however long the chat.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.summary = ""
+        # messages before this index are covered by the summary
+        self.summarized = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def to_dict(self):
+        return {"messages": self.messages, "summary": self.summary, "summarized": self.summarized}
+
+    @classmethod
+    def from_dict(cls, data):
+        history = cls()
+        history.messages = list(data.get("messages", []))
+        history.summary = data.get("summary", "")
+        history.summarized = data.get("summarized", 0)
+        return history
+
+    def append(self, prompt, reply):
+        self.messages.append(text_message("user", prompt))
+        self.messages.append(text_message("assistant", reply))
+
+    def prompt_messages(self, model, routes, api_keys, budget=CHAT_HISTORY_TOKENS):
+        """The history to send with the next message, summarizing turns that no longer fit `budget`."""
+        sizes = [count_tokens(model, message_text(message)) for message in self.messages]
+        keep = len(self.messages)
+        used = 0
+        # walk back over whole turns (user + assistant) while they fit
+        while keep - 2 >= self.summarized and used + sizes[keep - 2] + sizes[keep - 1] <= budget:
+            keep -= 2
+            used += sizes[keep] + sizes[keep + 1]
+
+        if keep > self.summarized:
+            try:
+                self.summary = summarize_turns(routes, api_keys, self.summary, self.messages[self.summarized:keep])
+                self.summarized = keep
+            except RetryError:
+                # this time the turns go along in full, over budget; the next message tries the summary again
+                pass
+
+        recent = self.messages[self.summarized:]
+        if not self.summary:
+            return recent
+        return [text_message("user", f"Summary of our conversation so far: {self.summary}"),
+                text_message("assistant", "Got it, I'll keep that in mind."),
+                *recent]
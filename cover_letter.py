@@ -0,0 +1,47 @@
+from functools import lru_cache, partial
+
+from fpdf import FPDF
+
+from metrics import span
+
+# font, font size, margin (mm), line height (mm)
+DEFAULT_LAYOUT = ("Times", 11, 20, 5)
+
+
+class PDF(FPDF):
+    def header(self):
+        pass
+
+
+@lru_cache(maxsize=64)
+def render_pdf(cover_letter_text, layout=DEFAULT_LAYOUT):
+    """Render the cover letter to PDF bytes, memoized on the text and layout."""
+    with span("cover_letter_pdf"):
+        return _render_pdf(cover_letter_text, layout)
+
+
+def _render_pdf(cover_letter_text, layout):
+    font, font_size, margin, line_height = layout
+    pdf = PDF()
+    pdf.add_page()
+
+    pdf.set_font(font, size=font_size)
+    pdf.set_left_margin(margin)
+    pdf.set_right_margin(margin)
+    pdf.set_top_margin(margin)
+    pdf.set_auto_page_break(auto=True, margin=margin)
+
+    paragraphs = cover_letter_text.split('\n\n')
+
+    for paragraph in paragraphs:
+        pdf.multi_cell(0, line_height, paragraph.strip(), align='L')
+        pdf.ln(line_height)
+
+    data = pdf.output(dest="S")
+    # fpdf returns a latin-1 str, fpdf2 returns a bytearray
+    return data.encode("latin-1") if isinstance(data, str) else bytes(data)
+
+
+def pdf_renderer(cover_letter_text, layout=DEFAULT_LAYOUT):
+    """A zero-argument callable for `st.download_button`, so the PDF is only built when it is downloaded."""
+    return partial(render_pdf, cover_letter_text, layout)
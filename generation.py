@@ -0,0 +1,372 @@
+import time
+from collections import namedtuple
+
+from json_extract import TruncatedError, extract_json
+from json_stream import JsonFieldStream
+from latex_compiler import compile_pdf, split_preamble, submit_compile, wait_compile
+from latex_lint import failing_regions, format_issues, lint, repair
+from metrics import count, observe, span
+from llm import (cached_block, get_client, record_claude_usage, record_openai_usage, response_cache, stream_claude,
+                 stream_openai)
+from resume_patch import PatchError, apply_edits
+from resume_prune import prune_resume
+from retry import RetryError, call_with_retry
+
+SYSTEM_PROMPT_START = ("You are an expert resume writer and job application specialist. "
+                       "Your task is to analyze the provided job posting and full resume, "
+                       "then create a tailored resume and cover letter. Output your response in "
+                       "JSON format with a 'resume' key containing latex code of new resume content, and "
+                       "a 'cover_letter' key containing the generated cover letter. and a 'name' key containg the name"
+                       " of the cover letter file. Try to name it "
+                       f"in a way that it can be easily identified. (eg: coverLetterUserxCompany)Ensure the JSON is"
+                       " properly formatted and escaped. No need to include ```json before the start"
+                       " of JSON string. You are NOT allowed to change the format of the resume in "
+                       "any way unless explicitly stated by the user/job posting. You must provide a "
+                       "complete resume in LaTeX format. The cover letter should be plain text."
+                       "REMEMBER: YOU SHOULD PROVIDE THE COMPLETE UPDATED CODE OF RESUME IN LATEX. "
+                       "You should not miss anything from the latex code. if you do, the compilation will fail\n\n"
+                       "Here are the custom instructions by the user: \n\n"
+                       )
+
+SYSTEM_PROMPT_EDITS = ("You are an expert resume writer and job application specialist. "
+                       "Your task is to analyze the provided job posting and full resume, "
+                       "then tailor the resume and write a cover letter. Do NOT rewrite the whole resume. "
+                       "Output your response in JSON format with an 'edits' key containing a list of changes to the "
+                       "resume, a 'cover_letter' key containing the generated cover letter, and a 'name' key containg "
+                       "the name of the cover letter file. Try to name it in a way that it can be easily identified. "
+                       "(eg: coverLetterUserxCompany) Each edit is either "
+                       "{\"find\": \"<exact latex copied from the resume>\", \"replace\": \"<new latex>\"} to change an "
+                       "item or a line, or {\"section\": \"<section title>\", \"latex\": \"<new latex of the section>\"} to "
+                       "rewrite a whole section without its \\section heading. Every 'find' must match the resume "
+                       "exactly once, so include enough of the line to make it unique. Only include what changes. "
+                       "Ensure the JSON is properly formatted and escaped. No need to include ```json before the "
+                       "start of JSON string. You are NOT allowed to change the format of the resume in any way "
+                       "unless explicitly stated by the user/job posting. The cover letter should be plain text.\n\n"
+                       "Here are the custom instructions by the user: \n\n"
+                       )
+
+SYSTEM_PROMPT_FIX_LATEX = ("You fix structural errors in a part of a LaTeX resume: unbalanced braces, environments "
+                           "that are not closed and similar. Change nothing else, keep the wording and formatting "
+                           "exactly as they are. Output your response in JSON format with a 'latex' key containing "
+                           "the corrected LaTeX of the part you were given, and nothing before or after it.")
+
+GENERATION_TEMPERATURE = {"OpenAI": 0.5, "Claude": 0.3}
+RESPONSE_KEYS = ("resume", "cover_letter", "name")
+EDIT_RESPONSE_KEYS = ("edits", "cover_letter", "name")
+
+# everything a generation needs, captured from the session when it is submitted so it can run without Streamlit;
+# `temperature` overrides GENERATION_TEMPERATURE and `repair_routes` are used to fix broken LaTeX instead of `routes`
+GenerationRequest = namedtuple("GenerationRequest", [
+    "routes", "api_keys", "mode", "system_prompt", "edits_system_prompt", "context", "question", "current_latex",
+    "temperature", "repair_routes",
+], defaults=[None, None])
+
+
+class Cancelled(BaseException):
+    """Raised inside a generation when its job is cancelled.
+
+    Derives from BaseException, like asyncio.CancelledError, so retry loops don't treat it as a failure.
+    """
+
+
+def validate_json(final_dict, required=()):
+    if isinstance(final_dict, dict):
+        return final_dict
+
+    with span("parse_json"):
+        return extract_json(final_dict, required)
+
+
+def compile_latex(latex_code):
+    """Compile LaTeX to a PDF and return `(pdf_path, None)`, or `(None, log)` when the compile failed."""
+    with span("compile"):
+        pdf_path, log_content = compile_pdf(latex_code)
+    if log_content is not None:
+        return None, log_content
+    return pdf_path, None
+
+
+def build_request(routes, api_keys, latex, job_title, job_description, about_you, system_prompt,
+                  cover_letter_prompt, mode="Full resume"):
+    """Assemble the prompts for tailoring `latex` to one job posting into a `GenerationRequest`.
+
+    A long master resume is first cut down to the entries most relevant to the posting.
+    """
+    latex = prune_resume(latex, f"{job_title}\n{job_description}")
+    context = (f"Resume: {latex} \n"
+               f"Cover Letter Instructions: {cover_letter_prompt} \n")
+    question = (f"Job Title: {job_title}; \n"
+                f"Job Description: {job_description}; \n"
+                f"About User: {about_you}; \n")
+    return GenerationRequest(
+        routes=routes,
+        api_keys=api_keys,
+        mode=mode,
+        system_prompt=SYSTEM_PROMPT_START + system_prompt,
+        edits_system_prompt=SYSTEM_PROMPT_EDITS + system_prompt,
+        context=context,
+        question=question,
+        current_latex=latex,
+    )
+
+
+def request_messages(route, system_prompt, context, question):
+    """The provider-specific `(system, messages)` for a generation.
+
+    The system prompt and `context` (resume + instructions) come first and rarely change between requests,
+    so Claude's cache breakpoint and OpenAI's automatic prefix caching can reuse them.
+    """
+    if route.provider == "OpenAI":
+        return None, [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": system_prompt
+                    }
+                ]
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": context
+                    },
+                    {
+                        "type": "text",
+                        "text": question
+                    }
+                ]
+            }
+        ]
+    system = [
+        {
+            "type": "text",
+            "text": system_prompt
+        }
+    ]
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                cached_block(context),
+                {
+                    "type": "text",
+                    "text": question
+                }
+            ]
+        }
+    ]
+    return system, messages
+
+
+def stream_response(routes, api_keys, system_prompt, context, question, response_keys, job=None,
+                    early_compile=True, throttle=None, temperature=None, task="resume"):
+    """Generate a response, streaming it into `job.partial` when a job is given.
+
+    Returns `(response, compile_future)`; unless `early_compile` is off, the compile is started as soon as
+    the resume field is complete, while the rest of the response is still streaming. `throttle(route)` is
+    called before every request to the model, and `temperature` overrides the provider's default. `task`
+    is what the router's statistics file the calls under. Raises `RetryError` when every route failed.
+    """
+    def attempt(route):
+        parser = JsonFieldStream()
+        if job is not None:
+            job.partial = parser
+        compile_future = None
+        response_text = ""
+        client = get_client(route.provider, api_keys[route.provider])
+        route_temperature = GENERATION_TEMPERATURE[route.provider] if temperature is None else temperature
+        system, messages = request_messages(route, system_prompt, context, question)
+        cache_key = response_cache.key(route.provider, route.model, route_temperature, system, messages)
+        cached = response_cache.get(cache_key)
+        count("llm_response_cache_total", help="Model responses served from the response cache",
+              result="miss" if cached is None else "hit")
+        if cached is None and throttle is not None:
+            throttle(route)
+        if cached is not None:
+            chunks = [cached]
+        elif route.provider == "OpenAI":
+            chunks = stream_openai(client, route.model, messages, temperature=route_temperature)
+        else:
+            chunks = stream_claude(client, route.model, system, messages, temperature=route_temperature,
+                                   max_tokens=4000)
+
+        with span("llm", provider=route.provider, model=route.model):
+            started = time.perf_counter()
+            for chunk in chunks:
+                if job is not None and job.cancelled:
+                    raise Cancelled()
+                if not response_text:
+                    observe("llm_first_token", time.perf_counter() - started, provider=route.provider,
+                            model=route.model)
+                response_text += chunk
+                closed = parser.feed(chunk)
+                if early_compile and "resume" in closed and not lint(parser.get("resume")):
+                    compile_future = submit_compile(parser.get("resume"))
+
+        if job is not None:
+            job.stage = "parsing"
+        with span("parse_json"):
+            # a field that was opened but never closed was cut off; repairing the JSON would pass it off as whole
+            cut_off = [key for key in response_keys if parser.get(key) is not None and not parser.is_closed(key)]
+            if cut_off:
+                raise TruncatedError(f"The response was cut off in the middle of {', '.join(cut_off)}")
+            if all(parser.is_closed(key) for key in response_keys):
+                response = parser.values()
+            else:
+                response = extract_json(response_text, response_keys)
+        missing = [key for key in response_keys if key not in response]
+        if missing:
+            raise KeyError(f"Response is missing {', '.join(missing)}")
+        if response.get("resume") != parser.get("resume"):
+            compile_future = None
+        response_cache.put(cache_key, response_text)
+        return response, compile_future
+
+    def on_retry(route, error, delay):
+        if job is not None:
+            job.stage = "calling model"
+            job.log(f"Error from {route.model}: {error}. Retrying in {delay:.1f}s...")
+
+    def on_failover(route, error):
+        if job is not None:
+            job.log(f"{route.model} failed ({error}). Trying the next model...")
+
+    route, result = call_with_retry(routes, attempt, on_retry=on_retry, on_failover=on_failover, task=task)
+    if job is not None:
+        job.route = route
+    return result
+
+
+def generate_response(request, job=None, early_compile=True, throttle=None):
+    """Get the tailored resume and cover letter for `request` from the model.
+
+    Returns `(response, compile_future)` like `stream_response`; in section edits mode the edits are
+    applied to the current resume, falling back to a full resume when they can't be.
+    """
+    if job is not None:
+        job.stage = "calling model"
+    if request.mode == "Section edits":
+        try:
+            response, _ = stream_response(request.routes, request.api_keys, request.edits_system_prompt,
+                                          request.context, request.question, EDIT_RESPONSE_KEYS, job,
+                                          throttle=throttle, temperature=request.temperature, task="edits")
+            response["resume"] = apply_edits(request.current_latex, response.get("edits"))
+            return response, None
+        except (PatchError, RetryError) as e:
+            if job is not None:
+                job.log(f"Couldn't apply the edits ({e}). Regenerating the full resume...")
+                job.stage = "calling model"
+
+    return stream_response(request.routes, request.api_keys, request.system_prompt, request.context,
+                           request.question, RESPONSE_KEYS, job, early_compile=early_compile, throttle=throttle,
+                           temperature=request.temperature)
+
+
+def fix_region(routes, api_keys, region, issues):
+    """Ask the model to fix the structural `issues` in `region`, one section of a resume."""
+    question = f"Problems found:\n{format_issues(issues)}\n\nLaTeX to fix:\n{region}"
+
+    def attempt(route):
+        client = get_client(route.provider, api_keys[route.provider])
+        if route.provider == "OpenAI":
+            completion = client.chat.completions.create(
+                model=route.model,
+                messages=[{"role": "system", "content": SYSTEM_PROMPT_FIX_LATEX},
+                          {"role": "user", "content": question}],
+                max_tokens=4000
+            )
+            record_openai_usage(route.model, completion.usage)
+            text = completion.choices[0].message.content
+        else:
+            message = client.messages.create(
+                system=SYSTEM_PROMPT_FIX_LATEX,
+                messages=[{"role": "user", "content": question}],
+                model=route.model,
+                max_tokens=4000
+            )
+            record_claude_usage(route.model, message.usage)
+            text = message.content[0].text
+        fixed = validate_json(text, ("latex",)).get("latex")
+        if not isinstance(fixed, str):
+            raise KeyError("Response is missing latex")
+        return fixed
+
+    with span("fix_latex"):
+        _, fixed = call_with_retry(routes, attempt, task="repair")
+    return fixed
+
+
+def check_latex(latex, original, routes, api_keys, job=None):
+    """Lint a resume generated from `original` before it is compiled and fix what can be fixed.
+
+    Mechanical problems (a missing `\\end{document}`, an environment left open, a changed preamble) are
+    repaired in place; anything else is sent back to the model one failing section at a time rather
+    than regenerating the whole resume. Returns `(latex, issues)` with the issues still left.
+    """
+    parts = split_preamble(original)
+    preamble = parts[0] if parts else None
+    with span("lint"):
+        issues = lint(latex, preamble)
+        if issues:
+            latex = repair(latex, issues)
+            issues = lint(latex, preamble)
+    if not issues:
+        return latex, issues
+
+    if job is not None:
+        job.stage = "fixing LaTeX"
+        job.log(f"Asking the model to fix the LaTeX:\n{format_issues(issues)}")
+    # back to front, so the positions of the earlier regions stay valid
+    for start, end in reversed(failing_regions(latex, issues)):
+        if job is not None and job.cancelled:
+            raise Cancelled()
+        region_issues = [issue for issue in issues if start <= issue.position < end]
+        try:
+            fixed = fix_region(routes, api_keys, latex[start:end], region_issues)
+        except RetryError as e:
+            if job is not None:
+                job.log(f"Couldn't fix the LaTeX ({e}).")
+            break
+        latex = latex[:start] + fixed.rstrip("\n") + "\n" + latex[end:]
+    return latex, lint(latex, preamble)
+
+
+def check_error(issues):
+    """The compile error shown for a generated resume that is still broken after `check_latex`."""
+    return f"LaTeX check failed before compiling:\n{format_issues(issues)}"
+
+
+def run_generation(request, job=None):
+    """Tailor the resume and cover letter for one posting and compile the result.
+
+    Returns a dict with the response fields plus `pdf_path` and `compile_error`. Progress is reported
+    through `job.stage` when a job is given.
+    """
+    response, compile_future = generate_response(request, job)
+
+    if job is not None:
+        if job.cancelled:
+            raise Cancelled()
+        job.stage = "checking LaTeX"
+    latex, issues = check_latex(response["resume"], request.current_latex, request.repair_routes or request.routes,
+                                request.api_keys, job)
+    if latex != response["resume"]:
+        response["resume"] = latex
+        compile_future = None
+    if job is not None:
+        if job.cancelled:
+            raise Cancelled()
+        job.stage = "compiling"
+    if issues:
+        return {**response, "pdf_path": None, "compile_error": check_error(issues)}
+    with span("compile"):
+        if compile_future is None:
+            compile_future = submit_compile(response["resume"])
+        pdf_path, error = wait_compile(compile_future)
+    if job is not None and job.cancelled:
+        raise Cancelled()
+    return {**response, "pdf_path": pdf_path, "compile_error": error}
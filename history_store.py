@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from latex_compiler import CACHE_DIR, cache
+
+HISTORY_DB = os.environ.get("HISTORY_DB", os.path.join(os.path.dirname(CACHE_DIR), "history.sqlite3"))
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "20"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    session TEXT,
+    job_title TEXT NOT NULL,
+    company TEXT NOT NULL DEFAULT '',
+    job_description TEXT NOT NULL,
+    provider TEXT,
+    model TEXT,
+    system_prompt TEXT,
+    cover_letter_prompt TEXT,
+    latex TEXT NOT NULL,
+    cover_letter TEXT,
+    cover_letter_name TEXT,
+    chat TEXT,
+    pdf_hash TEXT REFERENCES pdfs (hash),
+    compile_error TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS generations_created ON generations (created);
+CREATE INDEX IF NOT EXISTS generations_company ON generations (company COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS pdfs (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+-- MinHash signatures of the job descriptions, for finding reposted jobs (see near_duplicates.py)
+CREATE TABLE IF NOT EXISTS posting_signatures (
+    id INTEGER PRIMARY KEY REFERENCES generations (id) ON DELETE CASCADE,
+    signature BLOB NOT NULL
+);
+"""
+
+# full-text index over the postings, kept in sync with `generations` by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+    job_title, company, job_description, content='generations', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts (rowid, job_title, company, job_description)
+    VALUES (new.id, new.job_title, new.company, new.job_description);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, job_title, company, job_description)
+    VALUES ('delete', old.id, old.job_title, old.company, old.job_description);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_fts_update AFTER UPDATE OF job_title, company, job_description
+ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, job_title, company, job_description)
+    VALUES ('delete', old.id, old.job_title, old.company, old.job_description);
+    INSERT INTO generations_fts (rowid, job_title, company, job_description)
+    VALUES (new.id, new.job_title, new.company, new.job_description);
+END;
+"""
+
+# what the sidebar lists; the LaTeX, letter and PDF are only read when an entry is restored
+SUMMARY_COLUMNS = "g.id, g.created, g.job_title, g.company, g.provider, g.model, g.pdf_hash IS NOT NULL AS compiled"
+
+_WORD = re.compile(r"\w+")
+
+
+def fts_query(text):
+    """A full-text query matching entries with a word starting with each word of `text`."""
+    words = _WORD.findall(text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class HistoryStore:
+    """Every generation, with its posting, prompts, LaTeX, cover letter, chat and PDF, in a local SQLite file.
+
+    One connection is shared by the app's threads behind a lock; the database runs in WAL mode, so
+    the batch runner or a second app process can use the same file. PDFs are stored once per hash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+            try:
+                self._connection.executescript(FTS_SCHEMA)
+                self.full_text = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5, search falls back to LIKE
+                self.full_text = False
+
+    def record(self, *, session, job_title, company, job_description, provider, model, system_prompt,
+               cover_letter_prompt, latex, cover_letter, cover_letter_name, pdf_path, compile_error, timings):
+        """Store one generation and return its id."""
+        pdf_hash = None
+        pdf_data = None
+        if pdf_path:
+            with open(pdf_path, "rb") as pdf_file:
+                pdf_data = pdf_file.read()
+            pdf_hash = hashlib.sha256(pdf_data).hexdigest()
+        with self._lock, self._connection:
+            if pdf_hash is not None:
+                self._connection.execute("INSERT OR IGNORE INTO pdfs (hash, data) VALUES (?, ?)",
+                                         (pdf_hash, pdf_data))
+            cursor = self._connection.execute(
+                "INSERT INTO generations (created, session, job_title, company, job_description, provider, model, "
+                "system_prompt, cover_letter_prompt, latex, cover_letter, cover_letter_name, pdf_hash, "
+                "compile_error, timings) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), session, job_title, company or "", job_description, provider, model, system_prompt,
+                 cover_letter_prompt, latex, cover_letter, cover_letter_name, pdf_hash, compile_error,
+                 json.dumps(timings)))
+        return cursor.lastrowid
+
+    def update_chat(self, entry_id, chat, cover_letter, cover_letter_name):
+        """Save the chat transcript of an entry and the cover letter it led to."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE generations SET chat = ?, cover_letter = ?, cover_letter_name = ? WHERE id = ?",
+                (json.dumps(chat), cover_letter, cover_letter_name, entry_id))
+
+    def page(self, search="", before=None, limit=HISTORY_PAGE_SIZE):
+        """Summaries of the newest entries older than id `before`, matching `search` when given.
+
+        Pages by id rather than offset, so loading more stays cheap however far back the user scrolls.
+        """
+        source = "generations g"
+        conditions = []
+        parameters = []
+        query = fts_query(search)
+        if query is not None and self.full_text:
+            source = "generations_fts JOIN generations g ON g.id = generations_fts.rowid"
+            conditions.append("generations_fts MATCH ?")
+            parameters.append(query)
+        elif query is not None:
+            conditions.append("(g.job_title LIKE ? OR g.company LIKE ? OR g.job_description LIKE ?)")
+            parameters.extend([f"%{search.strip()}%"] * 3)
+        if before is not None:
+            conditions.append("g.id < ?")
+            parameters.append(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        sql = f"SELECT {SUMMARY_COLUMNS} FROM {source} {where} ORDER BY g.id DESC LIMIT ?"
+        parameters.append(limit)
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, parameters)]
+
+    def get(self, entry_id):
+        """Everything stored for one entry, with `chat` and `timings` decoded, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM generations WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["chat"] = json.loads(entry["chat"]) if entry["chat"] else None
+        entry["timings"] = json.loads(entry["timings"]) if entry["timings"] else {}
+        return entry
+
+    def save_signature(self, entry_id, signature):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO posting_signatures (id, signature) VALUES (?, ?)",
+                                     (entry_id, signature))
+
+    def signatures(self):
+        """`(id, signature)` of every entry whose posting signature has been saved."""
+        with self._lock:
+            return self._connection.execute("SELECT id, signature FROM posting_signatures").fetchall()
+
+    def unsigned_postings(self):
+        """`(id, job_description)` of the entries without a saved signature."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT g.id, g.job_description FROM generations g "
+                "LEFT JOIN posting_signatures s ON s.id = g.id WHERE s.id IS NULL").fetchall()
+
+    def pdf(self, pdf_hash):
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM pdfs WHERE hash = ?", (pdf_hash,)).fetchone()
+        return row["data"] if row else None
+
+    def restore_pdf(self, entry):
+        """Path of the entry's PDF in the compile cache, putting it back there if it was evicted.
+
+        Returns None when the entry didn't compile. No compile is run either way.
+        """
+        if not entry["pdf_hash"]:
+            return None
+        key = cache.key(entry["latex"])
+        cached = cache.get(key)
+        if cached is not None and cached[0] is not None:
+            return cached[0]
+        data = self.pdf(entry["pdf_hash"])
+        if data is None:
+            return None
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(data)
+            pdf_file.flush()
+            return cache.put_pdf(key, pdf_file.name)
+
+
+store = HistoryStore(HISTORY_DB)
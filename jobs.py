@@ -0,0 +1,95 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from generation import Cancelled
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+
+ACTIVE_STAGES = ("queued", "calling model", "parsing", "checking LaTeX", "fixing LaTeX", "compiling")
+
+_ids = itertools.count(1)
+
+
+class Job:
+    """Handle for a generation running in the background.
+
+    The worker thread moves `stage` through queued, calling model, parsing, checking (and possibly
+    fixing) the LaTeX and compiling to done, failed or cancelled. The page polls it; nothing in here
+    touches Streamlit.
+    """
+
+    def __init__(self, label, parent=None):
+        self.id = next(_ids)
+        self.label = label
+        # a part of a larger job, e.g. one of several candidates; it is cancelled with its parent
+        self.parent = parent
+        self.stage = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.route = None
+        self.partial = None
+        self.messages = []
+        self.applied = False
+        self._future = None
+        self._cancel = threading.Event()
+
+    @property
+    def active(self):
+        return self.stage in ACTIVE_STAGES
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.created
+
+    def log(self, message):
+        self.messages.append(message)
+        if self.parent is not None:
+            self.parent.log(f"{self.label}: {message}")
+
+    def cancel(self):
+        self._cancel.set()
+        if self._future is not None and self._future.cancel():
+            self._finish("cancelled")
+
+    def _finish(self, stage, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self.stage = stage
+
+
+class JobExecutor:
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation")
+
+    def submit(self, label, fn, *args):
+        """Run `fn(*args, job=job)` in the background and return the job handle right away."""
+        job = Job(label)
+        job._future = self._executor.submit(self._run, job, fn, args)
+        return job
+
+    @staticmethod
+    def _run(job, fn, args):
+        if job.cancelled:
+            job._finish("cancelled")
+            return
+        try:
+            result = fn(*args, job=job)
+        except Cancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            job._finish("failed", error=e)
+        else:
+            job._finish("done", result=result)
+
+
+executor = JobExecutor(JOB_WORKERS)
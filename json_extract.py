@@ -0,0 +1,145 @@
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_VALID_ESCAPES = set('"\\/bfnrt')
+# \b, \f, \r and \t directly followed by a letter are far more likely \textbf, \footnotesize,
+# \resumeItem or \begin than a control character
+LATEX_LIKE_ESCAPES = set("bfrt")
+_HEX_DIGITS = set("0123456789abcdefABCDEF")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class TruncatedError(ValueError):
+    """The response was cut off in the middle of a field the caller needs."""
+
+
+class ParseStats:
+    """Counters for `extract_json`, shared by every session in the process.
+
+    `saved` counts responses the old `split('{')[1].split('}')[0]` parser would have rejected,
+    each of which used to cost another paid model call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"total": 0, "clean": 0, "repaired": 0, "failed": 0, "saved": 0}
+
+    def record(self, outcome, saved=False):
+        with self._lock:
+            self._counts["total"] += 1
+            self._counts[outcome] += 1
+            if saved:
+                self._counts["saved"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+parse_stats = ParseStats()
+
+
+def _legacy_parses(text):
+    try:
+        json.loads(text.split('{')[1].split("}")[0].replace("```json(", "").replace(")```", "").replace("`", ""),
+                   strict=False)
+        return True
+    except (IndexError, ValueError):
+        return False
+
+
+def _scan(text, start):
+    """Copy the object starting at `text[start]` in one pass, repairing what a model typically gets wrong.
+
+    Returns the candidate JSON text and the set of repairs made.
+    """
+    out = []
+    stack = []
+    repairs = set()
+    in_string = False
+    segment_start = start
+    index = start
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if in_string:
+            if char == "\\":
+                following = text[index + 1] if index + 1 < length else ""
+                if following == "u":
+                    digits = text[index + 2:index + 6]
+                    if len(digits) == 4 and _HEX_DIGITS.issuperset(digits):
+                        index += 6
+                        continue
+                elif following in _VALID_ESCAPES and not (following in LATEX_LIKE_ESCAPES and
+                                                           text[index + 2:index + 3].isalpha()):
+                    index += 2
+                    continue
+                # a LaTeX command like \section or \% written with a single backslash
+                out.append(text[segment_start:index])
+                out.append("\\\\")
+                segment_start = index + 1
+                repairs.add("escapes")
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append(char)
+        elif char in "}]" and stack:
+            stack.pop()
+            if not stack:
+                out.append(text[segment_start:index + 1])
+                return "".join(out), repairs
+        index += 1
+
+    # the output was cut off, close whatever is still open
+    repairs.add("truncated")
+    out.append(text[segment_start:])
+    candidate = "".join(out)
+    if in_string or len(stack) > 1 or candidate.rstrip().endswith(":"):
+        # not just the closing brace is missing, the value being written is incomplete
+        repairs.add("truncated value")
+    if in_string:
+        candidate += '"'
+    candidate = candidate.rstrip().rstrip(",")
+    if candidate.endswith(":"):
+        candidate += " null"
+    return candidate + "".join(_CLOSERS[opener] for opener in reversed(stack)), repairs
+
+
+def extract_json(text, required=()):
+    """Return the outermost JSON object in a model response as a dict.
+
+    Finds the object in a single linear scan, so prose or code fences around it don't matter, and
+    repairs single backslashes from LaTeX and output that was cut off mid-object. Raises
+    `ValueError` when there is no usable object, and `TruncatedError` when the output was cut off
+    in the middle of one of the `required` keys, whose value would otherwise look complete.
+    """
+    start = text.find("{")
+    if start == -1:
+        parse_stats.record("failed")
+        raise ValueError("No JSON object found in the response")
+
+    candidate, repairs = _scan(text, start)
+    try:
+        result = json.loads(candidate, strict=False)
+        if not isinstance(result, dict):
+            raise ValueError("The response is not a JSON object")
+    except ValueError:
+        parse_stats.record("failed")
+        logger.info("Could not parse model response (repairs tried: %s)", ", ".join(sorted(repairs)) or "none")
+        raise
+    # the value that was being written when the output stopped is the last one in the object
+    cut_off = next(reversed(result), None) if "truncated value" in repairs else None
+    if cut_off in required:
+        parse_stats.record("failed")
+        raise TruncatedError(f"The response was cut off in the middle of {cut_off}")
+
+    saved = not _legacy_parses(text)
+    parse_stats.record("repaired" if repairs else "clean", saved=saved)
+    if repairs:
+        logger.info("Parsed model response after repairing %s", ", ".join(sorted(repairs)))
+    return result
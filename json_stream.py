@@ -0,0 +1,124 @@
+from json_extract import LATEX_LIKE_ESCAPES
+
+_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonFieldStream:
+    """Incrementally decodes the top-level string fields of a JSON object as its text streams in.
+
+    Feed it chunks of model output with `feed`; `get` returns whatever has been decoded for a
+    field so far and `feed` reports the fields whose closing quote arrived in that chunk. Text
+    before the opening brace (prose, code fences) is ignored, and escapes that are not valid JSON,
+    like the backslashes of LaTeX commands, are kept as written instead of failing the parse.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.closed = []
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = None
+        self._expect_key = True
+        self._key = None
+        self._target = None
+
+    def feed(self, chunk):
+        closed = []
+        for char in chunk:
+            if self.done:
+                break
+            if self._in_string:
+                if self._escape is not None and self._read_escape(char):
+                    continue
+                if char == "\\":
+                    self._escape = ""
+                elif char == '"':
+                    self._in_string = False
+                    closed.extend(self._close_string())
+                elif self._target is not None:
+                    self._target.append(char)
+                continue
+
+            if char == '"':
+                if self._depth == 0:
+                    continue
+                self._in_string = True
+                self._open_string()
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 0:
+                    continue
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+            elif char == "," and self._depth == 1:
+                self._expect_key = True
+        return closed
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return "".join(self.fields[key]).encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+
+    def is_closed(self, key):
+        return key in self.closed
+
+    def values(self):
+        return {key: self.get(key) for key in self.closed}
+
+    def _open_string(self):
+        if self._depth != 1:
+            self._target = None
+        elif self._expect_key:
+            self._target = []
+            self._key = self._target
+        else:
+            self._target = []
+            self.fields[self._target_key()] = self._target
+
+    def _target_key(self):
+        return "".join(self._key)
+
+    def _close_string(self):
+        target, self._target = self._target, None
+        if self._depth != 1 or target is None:
+            return []
+        if self._expect_key:
+            self._expect_key = False
+            return []
+        key = self._target_key()
+        if key not in self.closed:
+            self.closed.append(key)
+        return [key]
+
+    def _read_escape(self, char):
+        """Consume `char` as part of an escape sequence; returns False if it belongs to the text after it."""
+        if self._escape in LATEX_LIKE_ESCAPES:
+            # \\textbf, \\begin, ... written with a single backslash, see json_extract
+            escape, self._escape = self._escape, None
+            self._emit("\\" + escape if char.isalpha() else _SIMPLE_ESCAPES[escape])
+            return False
+
+        if self._escape == "":
+            if char == "u" or char in LATEX_LIKE_ESCAPES:
+                self._escape = char
+                return True
+            self._escape = None
+            self._emit(_SIMPLE_ESCAPES.get(char, "\\" + char))
+            return True
+
+        self._escape += char
+        if len(self._escape) < 5:
+            return True
+        hex_digits, self._escape = self._escape[1:], None
+        try:
+            self._emit(chr(int(hex_digits, 16)))
+        except ValueError:
+            self._emit("\\u" + hex_digits)
+        return True
+
+    def _emit(self, text):
+        if self._target is not None:
+            self._target.extend(text)
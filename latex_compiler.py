@@ -0,0 +1,400 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+
+from metrics import count, observe
+
+LATEX_ENGINE = os.environ.get("LATEX_ENGINE", "pdflatex")
+LATEX_ARGS = ["-interaction=nonstopmode"]
+
+CACHE_DIR = os.environ.get("PDF_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "pdf"))
+CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+COMPILE_WORKERS = int(os.environ.get("COMPILE_WORKERS", str(os.cpu_count() or 1)))
+COMPILE_QUEUE_SIZE = int(os.environ.get("COMPILE_QUEUE_SIZE", "32"))
+COMPILE_TIMEOUT = float(os.environ.get("COMPILE_TIMEOUT", "60"))
+COMPILE_QUEUE_TIMEOUT = float(os.environ.get("COMPILE_QUEUE_TIMEOUT", "120"))
+
+# Dump the document preamble into a format file once (via mylatexformat) and start later compiles
+# from it, so pdflatex skips re-reading packages, fonts and macros when only the body changed.
+FAST_PREAMBLE = os.environ.get("LATEX_FAST_PREAMBLE", "1") == "1"
+FORMAT_DIR = os.environ.get("LATEX_FORMAT_DIR", os.path.join(os.path.dirname(CACHE_DIR), "fmt"))
+# where a resume's own classes, packages, images and \input files are found, like it was when pdflatex ran in
+# the app directory
+LATEX_ASSETS_DIR = os.path.abspath(os.environ.get("LATEX_ASSETS_DIR", "."))
+
+# \documentclass, \usepackage, \input, \includegraphics and the like, with the file names they load
+_ASSET_REFERENCE = re.compile(
+    r"\\(documentclass|usepackage|RequirePackage|input|include|includegraphics|includepdf|bibliography)"
+    r"\s*(?:\[[^\]]*\]\s*)?\{([^{}]+)\}")
+_ASSET_EXTENSIONS = {
+    "documentclass": [".cls"],
+    "usepackage": [".sty"],
+    "RequirePackage": [".sty"],
+    "input": ["", ".tex"],
+    "include": [".tex"],
+    "includegraphics": ["", ".pdf", ".png", ".jpg", ".jpeg", ".eps"],
+    "includepdf": ["", ".pdf"],
+    "bibliography": [".bib"],
+}
+
+
+def local_assets(latex_code, directory=LATEX_ASSETS_DIR):
+    """`(path, mtime, size)` of the files in `directory` that `latex_code` loads directly.
+
+    Part of the compile cache key, so editing a local class, package or image recompiles the resume.
+    Files those load in turn aren't followed.
+    """
+    assets = []
+    for command, names in _ASSET_REFERENCE.findall(latex_code):
+        for name in names.split(","):
+            name = name.strip()
+            if not name:
+                continue
+            for extension in _ASSET_EXTENSIONS[command]:
+                path = os.path.join(directory, name + extension)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if os.path.isfile(path):
+                    assets.append((path, stat.st_mtime_ns, stat.st_size))
+                    break
+    return sorted(set(assets))
+
+
+def latex_env():
+    """Environment for pdflatex: local assets are found in LATEX_ASSETS_DIR, then the usual places."""
+    return {**os.environ, "TEXINPUTS": f"{LATEX_ASSETS_DIR}{os.pathsep}{os.environ.get('TEXINPUTS', '')}"}
+
+
+class CompileCache:
+    """On-disk cache of compile results keyed by a hash of the LaTeX source and engine settings.
+
+    A successful compile is stored as `<key>.pdf`, a failed one as `<key>.log`. File mtimes are
+    bumped on every hit so eviction can drop the least recently used entries once the cache grows
+    past `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(latex_code, engine=LATEX_ENGINE, args=LATEX_ARGS):
+        digest = hashlib.sha256()
+        for part in [engine, *args]:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        digest.update(latex_code.encode("utf-8"))
+        for path, mtime, size in local_assets(latex_code):
+            digest.update(f"\0{path}\0{mtime}\0{size}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key):
+        pdf_path = self._path(key, ".pdf")
+        log_path = self._path(key, ".log")
+        try:
+            os.utime(pdf_path)
+            return pdf_path, None
+        except FileNotFoundError:
+            pass
+        try:
+            with open(log_path, "r") as log_file:
+                log_content = log_file.read()
+            os.utime(log_path)
+            return None, log_content
+        except FileNotFoundError:
+            return None
+
+    def put_pdf(self, key, pdf_path):
+        target = self._path(key, ".pdf")
+        tmp_target = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(pdf_path, tmp_target)
+        os.replace(tmp_target, target)
+        self.evict()
+        return target
+
+    def put_log(self, key, log_content):
+        target = self._path(key, ".log")
+        tmp_target = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_target, "w") as log_file:
+            log_file.write(log_content)
+        os.replace(tmp_target, target)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.is_file() or entry.name.endswith(".tmp"):
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+cache = CompileCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+
+def split_preamble(latex_code):
+    """Split a document into `(preamble, body)` at `\\begin{document}`, or return `None` if there is none."""
+    index = latex_code.find("\\begin{document}")
+    if index == -1:
+        return None
+    return latex_code[:index], latex_code[index:]
+
+
+class PreambleFormats:
+    """Precompiled format files for document preambles, keyed by a hash of the preamble.
+
+    A format is built the first time a preamble is seen and reused by every later compile with the
+    same preamble. Editing the preamble changes its hash, so a fresh format is built automatically.
+    Preambles whose format fails to build are remembered and compiled the normal way. Local classes
+    and packages the preamble loads are part of the key too, so changing one rebuilds the format.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._building = {}
+        self._failed = set()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(preamble, engine=LATEX_ENGINE):
+        assets = "".join(f"\0{path}\0{mtime}\0{size}" for path, mtime, size in local_assets(preamble))
+        return hashlib.sha256(f"{engine}\0{preamble}{assets}".encode("utf-8")).hexdigest()
+
+    def get(self, preamble):
+        """Return the path of the format for `preamble`, building it first if needed."""
+        key = self.key(preamble)
+        fmt_path = os.path.join(self.directory, key + ".fmt")
+        if os.path.exists(fmt_path):
+            return fmt_path
+
+        with self._lock:
+            if key in self._failed:
+                return None
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            if not os.path.exists(fmt_path) and not self._build(preamble, fmt_path):
+                with self._lock:
+                    self._failed.add(key)
+        with self._lock:
+            self._building.pop(key, None)
+        return fmt_path if os.path.exists(fmt_path) else None
+
+    def _build(self, preamble, fmt_path):
+        with tempfile.TemporaryDirectory(prefix="resume-format-") as workdir:
+            with open(os.path.join(workdir, "preamble.tex"), "w") as f:
+                f.write(preamble)
+                f.write("\\begin{document}\n\\end{document}\n")
+            try:
+                result = subprocess.run([LATEX_ENGINE, "-ini", *LATEX_ARGS, "-jobname=preamble",
+                                         f"&{LATEX_ENGINE}", "mylatexformat.ltx", "preamble.tex"],
+                                        cwd=workdir, env=latex_env(), capture_output=True, text=True,
+                                        timeout=COMPILE_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                return False
+            built = os.path.join(workdir, "preamble.fmt")
+            if result.returncode != 0 or not os.path.exists(built):
+                return False
+            tmp_target = f"{fmt_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(built, tmp_target)
+            os.replace(tmp_target, fmt_path)
+            return True
+
+
+formats = PreambleFormats(FORMAT_DIR)
+
+
+class CompilePool:
+    """Bounded pool of pdflatex workers shared by every session in the process.
+
+    Each compile runs in its own temporary directory, so concurrent sessions never see each
+    other's output. At most `workers` pdflatex processes run at once and at most `queue_size`
+    more compiles may wait for a free worker; anything beyond that is rejected straight away.
+    Identical sources that are already being compiled share the running job.
+    """
+
+    def __init__(self, workers, queue_size, timeout, queue_timeout):
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdflatex")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def submit(self, key, latex_code):
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            if not self._slots.acquire(blocking=False):
+                return None
+            future = self._executor.submit(self._run, key, latex_code)
+            self._inflight[key] = future
+        future.add_done_callback(lambda _: self._release(key))
+        return future
+
+    def prepare_format(self, preamble):
+        self._executor.submit(formats.get, preamble)
+
+    def _release(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+        self._slots.release()
+
+    def _run(self, key, latex_code):
+        fmt_path = None
+        if FAST_PREAMBLE:
+            parts = split_preamble(latex_code)
+            if parts is not None:
+                fmt_path = formats.get(parts[0])
+
+        if fmt_path is not None:
+            pdf_path, log_content, format_error = self._compile(key, latex_code, fmt_path)
+            if not format_error:
+                return pdf_path, log_content
+            # a stale or broken format should never cost the user a compile, so retry without it
+        pdf_path, log_content, _ = self._compile(key, latex_code, None)
+        return pdf_path, log_content
+
+    def _compile(self, key, latex_code, fmt_path):
+        with tempfile.TemporaryDirectory(prefix="resume-compile-") as workdir:
+            tex_path = os.path.join(workdir, "resume.tex")
+            with open(tex_path, "w") as f:
+                f.write(latex_code)
+
+            args = [LATEX_ENGINE, *LATEX_ARGS]
+            if fmt_path is not None:
+                # formats are looked up in the working directory first
+                try:
+                    os.symlink(fmt_path, os.path.join(workdir, "preamble.fmt"))
+                except OSError:
+                    shutil.copyfile(fmt_path, os.path.join(workdir, "preamble.fmt"))
+                args.append("-fmt=preamble")
+
+            started = time.perf_counter()
+            try:
+                # Compile the .tex file to .pdf
+                result = subprocess.run([*args, "resume.tex"], cwd=workdir, env=latex_env(),
+                                        capture_output=True, text=True, timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                return None, f"{LATEX_ENGINE} did not finish within {self.timeout:g} seconds and was stopped.", False
+            finally:
+                observe("pdflatex", time.perf_counter() - started, fast_preamble="1" if fmt_path else "0")
+
+            # Read the log file
+            log_path = os.path.join(workdir, "resume.log")
+            if os.path.exists(log_path):
+                with open(log_path, "r", errors="replace") as log_file:
+                    log_content = log_file.read()
+            else:
+                log_content = "Log file not found."
+
+            if result.returncode != 0:
+                format_error = fmt_path is not None and (not os.path.exists(log_path)
+                                                         or "format file" in result.stdout)
+                if not format_error:
+                    cache.put_log(key, log_content)
+                return None, log_content, format_error
+            return cache.put_pdf(key, os.path.join(workdir, "resume.pdf")), None, False
+
+
+pool = CompilePool(COMPILE_WORKERS, COMPILE_QUEUE_SIZE, COMPILE_TIMEOUT, COMPILE_QUEUE_TIMEOUT)
+
+
+def submit_compile(latex_code):
+    """Start compiling `latex_code` without waiting for it.
+
+    Returns a future resolving to the same `(pdf_path, log_content)` pair as `compile_pdf`.
+    """
+    key = cache.key(latex_code)
+    cached = cache.get(key)
+    count("compile_cache_total", help="Compiles answered from the PDF cache",
+          result="miss" if cached is None else "hit")
+    future = None if cached is not None else pool.submit(key, latex_code)
+    if future is None:
+        future = Future()
+        future.set_result(cached or (None, "The compile queue is full. Please try again in a moment."))
+    return future
+
+
+def wait_compile(future):
+    try:
+        return future.result(timeout=pool.queue_timeout + pool.timeout)
+    except FutureTimeoutError:
+        return None, "Timed out waiting for a free LaTeX worker. Please try again in a moment."
+
+
+def compile_pdf(latex_code):
+    """Compile `latex_code` and return `(pdf_path, None)` on success or `(None, log_content)` on failure.
+
+    Results come from the compile cache when the same source has been compiled before; the
+    returned PDF path points into the cache and must not be deleted by the caller. Otherwise the
+    compile is queued on the shared worker pool and this call blocks until it finishes.
+    """
+    return wait_compile(submit_compile(latex_code))
+
+
+def warm_preamble(latex_code):
+    """Build the preamble format for `latex_code` in the background so the first compile is fast too."""
+    if not FAST_PREAMBLE:
+        return
+    parts = split_preamble(latex_code)
+    if parts is not None:
+        pool.prepare_format(parts[0])
+
+
+_PAGE_COUNT = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+_OBJECT_STREAM = re.compile(rb"<<([^<>]*/ObjStm[^<>]*)>>\s*stream\r?\n")
+
+
+@lru_cache(maxsize=256)
+def pdf_page_count(pdf_path):
+    """Number of pages of a compiled PDF, or None if it can't be told.
+
+    Reads the `/Count` of the page tree, looking inside compressed object streams too since pdflatex
+    puts the page tree there. Cached by path, which is safe for PDFs in the content-addressed cache.
+    """
+    try:
+        with open(pdf_path, "rb") as pdf_file:
+            data = pdf_file.read()
+    except OSError:
+        return None
+    chunks = [data]
+    for match in _OBJECT_STREAM.finditer(data):
+        end = data.find(b"endstream", match.end())
+        try:
+            chunks.append(zlib.decompress(data[match.end():end]))
+        except zlib.error:
+            continue
+    counts = [int(first or second) for chunk in chunks for first, second in _PAGE_COUNT.findall(chunk)]
+    # the root of the page tree counts every page, intermediate nodes only theirs
+    return max(counts) if counts else None
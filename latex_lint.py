@@ -0,0 +1,286 @@
+import re
+from collections import namedtuple
+
+from latex_compiler import split_preamble
+from resume_patch import END_DOCUMENT, SECTION_PATTERN
+
+VERBATIM_ENVIRONMENTS = ("verbatim", "verbatim*", "lstlisting", "minted", "comment")
+# commands whose first argument is a URL, where % and # are plain characters
+URL_COMMANDS = ("url", "href")
+
+_NEWCOMMAND = re.compile(r"\\(?:re)?newcommand\*?\s*(?:\{\\([A-Za-z]+)\}|\\([A-Za-z]+))\s*(?=\{)")
+_ENVIRONMENT_BODY = re.compile(r"\s*\\(begin|end)\s*\{([^{}]+)\}(?:\s*\[.*\])?\s*", re.DOTALL)
+
+# `repair` is a `(position, length, text)` replacement that fixes the issue, or None if it needs the model
+Issue = namedtuple("Issue", ["kind", "message", "position", "repair"])
+
+
+def line_number(latex, position):
+    return latex.count("\n", 0, position) + 1
+
+
+def _line_end(latex, position):
+    """Where a missing `}` for a brace opened at `position` most likely belongs: the end of its line."""
+    end = latex.find("\n", position)
+    end = len(latex) if end == -1 else end
+    comment = position
+    while True:
+        comment = latex.find("%", comment, end)
+        if comment == -1:
+            return end
+        if latex[comment - 1] != "\\":
+            return comment
+        comment += 1
+
+
+def _read_group(latex, index):
+    """Read `{name}` at `index` (after optional spaces); returns `(name, index after the group)` or None."""
+    while index < len(latex) and latex[index] in " \t":
+        index += 1
+    if index >= len(latex) or latex[index] != "{":
+        return None
+    close = latex.find("}", index)
+    if close == -1 or "{" in latex[index + 1:close]:
+        return None
+    return latex[index + 1:close], close + 1
+
+
+def _skip_url(latex, index):
+    """Index after the `{url}` argument starting at `index` (after optional spaces), or None if there isn't one."""
+    while index < len(latex) and latex[index] in " \t":
+        index += 1
+    if index >= len(latex) or latex[index] != "{":
+        return None
+    depth = 0
+    while index < len(latex):
+        char = latex[index]
+        if char == "\\":
+            index += 2
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return None
+
+
+def _group_end(latex, index):
+    """Index after the brace group opening at `latex[index]`, or None if it is never closed."""
+    depth = 0
+    while index < len(latex):
+        char = latex[index]
+        if char == "\\":
+            index += 2
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return None
+
+
+def environment_macros(preamble):
+    """`{name: (kind, environment)}` of the preamble's macros without arguments that only begin or end an
+    environment, like `\\newcommand{\\resumeItemListStart}{\\begin{itemize}}`."""
+    macros = {}
+    for match in _NEWCOMMAND.finditer(preamble):
+        end = _group_end(preamble, match.end())
+        if end is None:
+            continue
+        body = _ENVIRONMENT_BODY.fullmatch(preamble[match.end() + 1:end - 1])
+        if body is not None:
+            macros[match.group(1) or match.group(2)] = (body.group(1), body.group(2).strip())
+    return macros
+
+
+def _scan(latex, body_start, macros=None):
+    """Brace and environment issues of the document, in one pass.
+
+    Environments are only checked in the body, since preamble macros like
+    `\\newcommand{\\listStart}{\\begin{itemize}}` legitimately open environments they don't close.
+    In the body, uses of such `macros` (see `environment_macros`) count as the begin or end they stand for.
+    """
+    macros = macros or {}
+    issues = []
+    braces = []
+    environments = []
+    document_end = latex.rfind(END_DOCUMENT)
+    sections = [match.start() for match in SECTION_PATTERN.finditer(latex)]
+    index = 0
+    length = len(latex)
+    while index < length:
+        char = latex[index]
+        if char == "%":
+            newline = latex.find("\n", index)
+            index = length if newline == -1 else newline + 1
+            continue
+        if char == "{":
+            braces.append(index)
+        elif char == "}":
+            if braces:
+                braces.pop()
+            else:
+                issues.append(Issue("stray_brace", f"Line {line_number(latex, index)}: '}}' without a matching '{{'",
+                                    index, (index, 1, "")))
+        elif char == "\\":
+            name_end = index + 1
+            while name_end < length and latex[name_end].isalpha():
+                name_end += 1
+            name = latex[index + 1:name_end]
+            if not name:
+                # an escaped character like \{ or \%
+                index += 2
+                continue
+            if name == "verb" and name_end < length:
+                closing = latex.find(latex[name_end], name_end + 1)
+                index = length if closing == -1 else closing + 1
+                continue
+            if name in macros and index >= body_start:
+                kind, environment = macros[name]
+                _track_environment(latex, issues, environments, sections, document_end, kind, environment,
+                                   index, name_end, f"\\{name}")
+                index = name_end
+                continue
+            if name in URL_COMMANDS:
+                after = _skip_url(latex, name_end)
+                if after is not None:
+                    index = after
+                    continue
+            if name in ("begin", "end"):
+                group = _read_group(latex, name_end)
+                if group is not None:
+                    environment, after = group
+                    if name == "begin" and environment in VERBATIM_ENVIRONMENTS:
+                        closing = latex.find(f"\\end{{{environment}}}", after)
+                        index = length if closing == -1 else closing
+                        continue
+                    if index >= body_start and environment != "document":
+                        _track_environment(latex, issues, environments, sections, document_end, name,
+                                           environment, index, after, f"\\{name}{{{environment}}}")
+                    index = after
+                    continue
+            index = name_end
+            continue
+        index += 1
+
+    for start in braces:
+        issues.append(Issue("unclosed_brace", f"Line {line_number(latex, start)}: '{{' is never closed",
+                            start, (_line_end(latex, start), 0, "}")))
+    close_at = document_end if document_end != -1 else len(latex.rstrip())
+    for environment, start, opener in reversed(environments):
+        issues.append(_unclosed(latex, environment, start, opener, close_at, sections))
+    return issues
+
+
+def _unclosed(latex, environment, start, opener, revealed_at, sections):
+    # close it before the next \section at the latest, that's where the model usually forgot it
+    next_section = next((position for position in sections if position > start), revealed_at)
+    return Issue("unclosed_environment", f"Line {line_number(latex, start)}: {opener} is never closed",
+                 start, (min(next_section, revealed_at), 0, f"\\end{{{environment}}}\n"))
+
+
+def _track_environment(latex, issues, environments, sections, document_end, kind, environment, start, after,
+                       command):
+    if kind == "begin":
+        environments.append((environment, start, command))
+        return
+    if any(name == environment for name, _, _ in environments):
+        while environments[-1][0] != environment:
+            issues.append(_unclosed(latex, *environments.pop(), start, sections))
+        environments.pop()
+    else:
+        issues.append(Issue("stray_end", f"Line {line_number(latex, start)}: {command} without a matching "
+                                         f"\\begin{{{environment}}}", start, (start, after - start, "")))
+
+
+def lint(latex, preamble=None):
+    """Structural problems in a LaTeX document that would make pdflatex fail, as a list of `Issue`s.
+
+    Checks that braces and environments are balanced, that the document ends with `\\end{document}`
+    and, when `preamble` is given, that the document's preamble is exactly `preamble`. Takes a
+    few milliseconds even for long resumes, so it runs before every compile.
+    """
+    issues = []
+    parts = split_preamble(latex)
+    if parts is None:
+        issues.append(Issue("missing_begin_document", "The document has no \\begin{document}", 0, None))
+        body_start = len(latex)
+        macros = {}
+    else:
+        body_start = len(parts[0])
+        macros = environment_macros(parts[0])
+        if preamble is not None and parts[0] != preamble:
+            issues.append(Issue("preamble_changed", "The preamble differs from the original resume", 0,
+                                (0, body_start, preamble)))
+
+    issues.extend(_scan(latex, body_start, macros))
+    stripped = latex.rstrip()
+    document_end = latex.rfind(END_DOCUMENT)
+    if document_end == -1:
+        # after the scan's issues, so its fix lands after the braces and environments they close at the end
+        issues.append(Issue("missing_end_document", "The document doesn't end with \\end{document}", len(stripped),
+                            (len(stripped), len(latex) - len(stripped), f"\n{END_DOCUMENT}\n")))
+    elif any(line.strip() and not line.lstrip().startswith("%")
+             for line in latex[document_end + len(END_DOCUMENT):].splitlines()):
+        end = document_end + len(END_DOCUMENT)
+        issues.append(Issue("text_after_end_document",
+                            f"Line {line_number(latex, end)}: text after \\end{{document}}", end,
+                            (end, len(latex) - end, "\n")))
+    return issues
+
+
+def repair(latex, issues):
+    """Apply the automatic fixes of `issues`; returns the repaired document.
+
+    A changed preamble is put back first and the document linted again, since the other issues may be
+    in the preamble that was just replaced.
+    """
+    changed = next((issue for issue in issues if issue.kind == "preamble_changed"), None)
+    if changed is not None:
+        position, length, preamble = changed.repair
+        latex = latex[:position] + preamble + latex[position + length:]
+        issues = lint(latex, preamble)
+    # applied back to front so earlier positions stay valid; of two insertions at the same spot the
+    # later issue (the outer environment, then \end{document}) goes first and so ends up after the earlier one
+    fixes = sorted(((*issue.repair[:2], index) for index, issue in enumerate(issues) if issue.repair is not None),
+                   reverse=True)
+    last_start = len(latex) + 1
+    for position, length, index in fixes:
+        text = issues[index].repair[2]
+        # overlapping fixes (e.g. a stray brace inside a replaced preamble) are skipped
+        if position + length > last_start:
+            continue
+        latex = latex[:position] + text + latex[position + length:]
+        last_start = position
+    return latex
+
+
+def failing_regions(latex, issues):
+    """`(start, end)` of each section containing an issue, for sending just that part back to the model.
+
+    Issues in the preamble are left out, the model is told to keep it as it is; `repair` restores it.
+    """
+    sections = [match.start() for match in SECTION_PATTERN.finditer(latex)]
+    document_end = latex.rfind(END_DOCUMENT)
+    document_end = len(latex) if document_end == -1 else document_end
+    parts = split_preamble(latex)
+    body_start = len(parts[0]) + len("\\begin{document}") if parts else 0
+    regions = []
+    for issue in issues:
+        if issue.kind == "preamble_changed" or (parts and issue.position < len(parts[0])):
+            continue
+        start = max([position for position in sections if position <= issue.position], default=body_start)
+        end = min([position for position in sections if position > issue.position], default=document_end)
+        if (start, end) not in regions:
+            regions.append((start, end))
+    return sorted(regions)
+
+
+def format_issues(issues):
+    return "\n".join(issue.message for issue in issues)
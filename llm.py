@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import anthropic
+import openai
+from anthropic import Anthropic
+from openai import OpenAI
+
+from metrics import record_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("LLM_RESPONSE_CACHE_SIZE", "128"))
+
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+
+
+class ClientRegistry:
+    """Process-wide OpenAI/Anthropic clients, keyed on provider and API key.
+
+    Streamlit reruns the script for every interaction, so clients built inline would redo the TLS
+    handshake on every click. Clients here live for the whole process, and every client of a provider
+    shares one keep-alive connection pool regardless of the API key it was created with.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._http_clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def settings(sdk):
+        # build the Timeout/Limits objects from the SDK's own classes, which come from whichever HTTP
+        # library that SDK version is built on
+        timeout = sdk.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        limits = type(sdk.DEFAULT_CONNECTION_LIMITS)(max_connections=LLM_MAX_CONNECTIONS,
+                                                     max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                                                     keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+        return timeout, limits
+
+    def get(self, provider, api_key):
+        key = (provider, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest())
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self._create(provider, api_key)
+            return client
+
+    def _create(self, provider, api_key):
+        if provider == "OpenAI":
+            sdk, client_class = openai, OpenAI
+        elif provider == "Claude":
+            sdk, client_class = anthropic, Anthropic
+        else:
+            raise ValueError(f"Unknown provider: {provider}")
+
+        timeout, limits = self.settings(sdk)
+        http_client = self._http_clients.get(provider)
+        if http_client is None:
+            http_client = self._http_clients[provider] = sdk.DefaultHttpxClient(timeout=timeout, limits=limits)
+        # retries are handled by retry.call_with_retry, which knows about deadlines and failover
+        return client_class(api_key=api_key, http_client=http_client, timeout=timeout, max_retries=0)
+
+
+clients = ClientRegistry()
+
+
+def get_client(provider, api_key):
+    return clients.get(provider, api_key)
+
+
+class ResponseCache:
+    """Process-wide LRU cache of raw model responses.
+
+    Keyed on the provider, model, temperature and a hash of the full prompt, so clicking
+    regenerate with nothing changed returns the previous answer without another round trip.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(provider, model, temperature, *prompt):
+        payload = json.dumps([provider, model, temperature, prompt], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, text):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+
+@lru_cache(maxsize=16)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(model, text):
+    """Number of tokens `text` takes up for `model`.
+
+    Exact for OpenAI models when tiktoken is installed, otherwise estimated from the length; Claude's
+    tokenizer isn't available offline and averages a little under four characters per token.
+    """
+    if tiktoken is not None and not model.startswith("claude"):
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    return int(len(text) / (3.5 if model.startswith("claude") else 4)) + 1
+
+
+def cached_block(text):
+    """A Claude text block ending a prompt-cache prefix, so everything up to and including it is cached."""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+
+def stream_openai(client, model, messages, temperature=None, json_mode=True):
+    """Yield the text of an OpenAI chat completion as it is generated."""
+    kwargs = {"model": model, "messages": messages, "stream": True, "stream_options": {"include_usage": True}}
+    if temperature is not None:
+        kwargs["temperature"] = temperature
+    if json_mode:
+        kwargs["response_format"] = {"type": "json_object"}
+    for chunk in client.chat.completions.create(**kwargs):
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        if getattr(chunk, "usage", None):
+            record_openai_usage(model, chunk.usage)
+
+
+def stream_claude(client, model, system, messages, temperature, max_tokens=4000):
+    """Yield the text of a Claude message as it is generated."""
+    with client.messages.stream(system=system, messages=messages, model=model, temperature=temperature,
+                                max_tokens=max_tokens) as stream:
+        for text in stream.text_stream:
+            yield text
+        record_claude_usage(model, stream.get_final_message().usage)
+
+
+def record_openai_usage(model, usage):
+    # OpenAI-compatible servers may leave usage out
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    record_tokens("OpenAI", model, usage.prompt_tokens, usage.completion_tokens,
+                  getattr(details, "cached_tokens", 0) or 0)
+
+
+def record_claude_usage(model, usage):
+    if usage is None:
+        return
+    record_tokens("Claude", model, usage.input_tokens, usage.output_tokens,
+                  getattr(usage, "cache_read_input_tokens", 0) or 0)
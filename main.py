@@ -1,23 +1,32 @@
-import json
+import sqlite3
 import time
+import uuid
 from typing import final
 
 import streamlit as st
 from pylatexenc.latex2text import LatexNodes2Text
-import subprocess
-import base64
 import os
-from openai import OpenAI
 from os.path import join, dirname
 from dotenv import load_dotenv, set_key
-from anthropic import Anthropic
 # for the footer
 from htbuilder import HtmlElement, div, ul, li, br, hr, a, p, img, styles, classes, fonts
 from htbuilder.units import percent, px
 from htbuilder.funcs import rgba, rgb
-from fpdf import FPDF
 import random
-import tempfile
+from latex_compiler import warm_preamble
+from cover_letter import pdf_renderer
+from pdf_server import ensure_server, pdf_url
+from llm import cached_block, count_tokens, get_client, record_claude_usage, record_openai_usage, response_cache
+from metrics import METRICS_DEBUG_PANEL, span, trace_log, traced
+from retry import RetryError, call_with_retry, routes_for
+from router import choose as choose_routes, describe as describe_routing
+from resume_prune import prune_resume
+from chat_history import ChatHistory, message_text
+from generation import build_request, compile_latex, run_generation, validate_json
+from candidates import GENERATION_CANDIDATES, parse_candidates, run_candidates
+from jobs import executor as job_executor
+from history_store import HISTORY_PAGE_SIZE, store as history_store
+from near_duplicates import index_posting, shared_index, signature
 
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
@@ -25,6 +34,9 @@ load_dotenv(dotenv_path)
 # Set the page layout to wide
 st.set_page_config(layout="wide", page_title="Resume and Cover Letter Generator", page_icon=":pencil2:")
 
+# compiled PDFs are served by URL from the compile cache instead of being inlined into the page
+ensure_server()
+
 # initialize session states
 if "pdf_compiled" not in st.session_state:
     st.session_state.pdf_compiled = False
@@ -49,6 +61,19 @@ if "openai_model_name" not in st.session_state:
     st.session_state.openai_model_name = ""
 if "ai_model" not in st.session_state:
     st.session_state.ai_model = "OpenAI"
+if "generation_mode" not in st.session_state:
+    st.session_state.generation_mode = "Full resume"
+if "jobs" not in st.session_state:
+    st.session_state.jobs = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:12]
+if "chat_histories" not in st.session_state:
+    st.session_state.chat_histories = {"OpenAI": ChatHistory(), "Claude": ChatHistory(), "Auto": ChatHistory()}
+if "history_id" not in st.session_state:
+    # the history entry the loaded resume came from, chat turns are saved to it
+    st.session_state.history_id = None
+if "history_entries" not in st.session_state:
+    st.session_state.history_entries = None
 
 INITIAL_SYSTEM_PROMPT = os.environ["INITIAL_SYSTEM_PROMPT"]
 
@@ -67,11 +92,24 @@ if "job_description" not in st.session_state:
     st.session_state.job_description = ""
 if "job_title" not in st.session_state:
     st.session_state.job_title = ""
+# st.cache_data rather than lru_cache: this script runs again as a new module on every rerun
+@st.cache_data(max_entries=8, show_spinner=False)
+def _read_text(path, mtime_ns, size):
+    with open(path, 'r') as file:
+        return file.read()
+
+
+def read_text(path):
+    """Contents of a text file, only read from disk again when its modification time or size changed."""
+    stat = os.stat(path)
+    return _read_text(path, stat.st_mtime_ns, stat.st_size)
+
+
 if "resume" not in st.session_state:
     try:
-        with open("resume.tex", 'r') as file:
-            latex_code = file.read()
+        latex_code = read_text("resume.tex")
         st.session_state.resume = latex_code
+        warm_preamble(latex_code)
     except FileNotFoundError:
         st.error("No resume found. Please create a .tex file and paste your resume in that.")
         st.stop()
@@ -79,220 +117,518 @@ if "resume" not in st.session_state:
 if "cover_letter_file_name" not in st.session_state:
     st.session_state.cover_letter_file_name = "cover_letter"
 
-SYSTEM_PROMPT_START = ("You are an expert resume writer and job application specialist. "
-                       "Your task is to analyze the provided job posting and full resume, "
-                       "then create a tailored resume and cover letter. Output your response in "
-                       "JSON format with a 'resume' key containing latex code of new resume content, and "
-                       "a 'cover_letter' key containing the generated cover letter. and a 'name' key containg the name"
-                       " of the cover letter file. Try to name it "
-                       f"in a way that it can be easily identified. (eg: coverLetterUserxCompany)Ensure the JSON is"
-                       " properly formatted and escaped. No need to include ```json before the start"
-                       " of JSON string. You are NOT allowed to change the format of the resume in "
-                       "any way unless explicitly stated by the user/job posting. You must provide a "
-                       "complete resume in LaTeX format. The cover letter should be plain text."
-                       "REMEMBER: YOU SHOULD PROVIDE THE COMPLETE UPDATED CODE OF RESUME IN LATEX. "
-                       "You should not miss anything from the latex code. if you do, the compilation will fail\n\n"
-                       "Here are the custom instructions by the user: \n\n"
-                       )
-
-
-def validate_json(final_dict):
-    if isinstance(final_dict, dict):
-        return final_dict
-
-    final_dict = final_dict.split('{')[1].split("}")[0]
-
-    return json.loads(final_dict.replace("```json(", "").replace(")```", "").replace("`", ""), strict=False)
-
+def request_host():
+    # the PDF server runs on its own port next to the app, on whatever host the browser reached us by
+    host = st.context.headers.get("Host", "localhost")
+    return host.rsplit(":", 1)[0] if not host.endswith("]") else host
 
-def compile_latex(latex_code):
-    with open("temp.tex", "w") as f:
-        f.write(latex_code)
 
-    # Compile the .tex file to .pdf
-    result = subprocess.run(["pdflatex", "-interaction=nonstopmode", "temp.tex"], capture_output=True, text=True)
-
-    # Read the log file
-    if os.path.exists("temp.log"):
-        with open("temp.log", "r") as log_file:
-            log_content = log_file.read()
-    else:
-        log_content = "Log file not found."
-
-    if result.returncode != 0:
-        st.session_state.pdf_compiled = False
-        return None, log_content
-    else:
-        return "temp.pdf", None
-
-
-def pdf_to_base64(pdf_path):
-    with open(pdf_path, "rb") as pdf_file:
-        return base64.b64encode(pdf_file.read()).decode('utf-8')
-
-
-# Main page layout
-col_latex, col_main, col_pdf = st.columns([1, 2, 1])
-
-with col_latex:
+# The page is split into fragments that rerun on their own: typing in the editor, chatting or editing the
+# cover letter only re-executes that panel. Anything that changes another panel reruns the whole page.
+@st.fragment
+def latex_editor():
     col1, col2 = st.columns([3, 1])
     with col1:
         st.markdown("##### LaTeX Editor")
     placeholder = ("Enter LaTeX code here. Its recommended to use add your complete resume here. Include all your "
                    "sections + all of the projects, experience. LLM will automatically use all relevant information")
-    with open("resume.tex", 'r') as file:
-        temp = file.read()
+
+    # generated LaTeX can only be written to the editor before it is drawn, so it is handed over on a rerun
+    if "pending_latex_input" in st.session_state:
+        st.session_state.latex_input = st.session_state.pop("pending_latex_input")
 
     st.text_area("Enter LaTeX code here", height=1164,
-                 value=temp, label_visibility="collapsed", placeholder=placeholder, key="latex_input")
+                 value=read_text("resume.tex"), label_visibility="collapsed", placeholder=placeholder,
+                 key="latex_input")
     with col2:
         if st.button("Compile", help="Compile the LaTeX code to PDF."):
             pdf_path, error = compile_latex(st.session_state.latex_input)
             if error:
+                st.session_state.pdf_compiled = False
                 st.session_state.pdf_compilation_error = True
                 st.session_state.pdf_compilation_error_message = error
             else:
-                pdf_base64 = pdf_to_base64(pdf_path)
-                st.session_state.pdf_display = (
-                    f'<iframe src="data:application/pdf;base64,{pdf_base64}" '
-                    f'style="width: 100%; min-width: 600px; height: 1164px;" '
-                    f'type="application/pdf"></iframe>'
-                )
+                st.session_state.pdf_url = pdf_url(pdf_path, request_host())
                 st.session_state.pdf_compiled = True
-                # remove temporary files
-                os.remove("temp.pdf")
-                os.remove("temp.tex")
-                for aux_file in ["temp.aux", "temp.log"]:
-                    if os.path.exists(aux_file):
-                        os.remove(aux_file)
+            # the preview is another fragment
+            st.rerun()
 
-with col_pdf:
+
+@st.fragment
+def resume_preview():
     st.markdown("##### Resume Preview")
     if st.session_state.pdf_compiled is True:
-        st.markdown(st.session_state.pdf_display, unsafe_allow_html=True)
+        st.markdown(f'<iframe src="{st.session_state.pdf_url}" '
+                    f'style="width: 100%; min-width: 600px; height: 1164px;" '
+                    f'type="application/pdf"></iframe>', unsafe_allow_html=True)
     elif st.session_state.pdf_compilation_error is True:
         st.error("Error compiling LaTeX code. Please click on 'Generate Resume and cover letter' to try again.")
         st.write(st.session_state.pdf_compilation_error_message)
 
 
-def on_generate_resume():
-    current_latex = st.session_state.latex_input
-    job_title = st.session_state.job_title
-    job_description = st.session_state.job_description
-    about_you = st.session_state.about_you
+# Main page layout
+col_latex, col_main, col_pdf = st.columns([1, 2, 1])
+
+with col_latex:
+    latex_editor()
+
+with col_pdf:
+    resume_preview()
+
+
+def api_key_for(provider):
+    return st.session_state.openai_api_key if provider == "OpenAI" else st.session_state.claude_api_key
+
+
+def api_keys():
+    return {"OpenAI": st.session_state.openai_api_key, "Claude": st.session_state.claude_api_key}
 
-    question = (f"Job Title: {job_title}; \n"
-                f"Job Description: {job_description}; \n"
-                f"About User: {about_you}; \n"
-                f"Resume: {current_latex} \n"
-                f"Cover Letter Instructions: {st.session_state.cover_letter_system_prompt} \n")
 
+def selected_route():
     if st.session_state.ai_model == "OpenAI":
-        if st.session_state.job_title != "" and st.session_state.job_description != "":
-            client = OpenAI()
-            messages = [
-                {
-                    "role": "system",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": SYSTEM_PROMPT_START + st.session_state.system_prompt
-                        }
-                    ]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": question
-                        }
-                    ]
-                }
-            ]
-
-            for i in range(5):
-                try:
-                    response = client.chat.completions.create(
-                        model=st.session_state.openai_model_name,
-                        response_format={"type": "json_object"},
-                        messages=messages,
-                        temperature=0.5,
-                    ).choices[0].message.content
-                    response = validate_json(response)
-                    break
-                except Exception as e:
-                    api_error = st.toast(f"Error: {e}")
-                    time.sleep(1)
-                    api_error.toast("Retrying...")
-
-    elif st.session_state.ai_model == "Claude":
-        if st.session_state.job_title != "" and st.session_state.job_description != "":
-            # st.error("Please enter the job title and job description.")
-            client = Anthropic()
-            temperature = 0.3
-
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": question
-                        }
-                    ]
-                }
-            ]
-            for i in range(5):
-                try:
-                    response = client.messages.create(
-                        system=SYSTEM_PROMPT_START + st.session_state.system_prompt,
-                        messages=messages,
-                        model=st.session_state.claude_model_name,
+        return st.session_state.ai_model, st.session_state.openai_model_name
+    return st.session_state.ai_model, st.session_state.claude_model_name
+
+
+def task_routes(task, prompt_text, output_tokens=None):
+    """Routes for one request of `task` and a note on the choice.
+
+    That's the selected model and its fallbacks, or in Auto mode whatever the router picks for the
+    task, the prompt size and how the models have been doing lately (the note says what and why).
+    """
+    if st.session_state.ai_model != "Auto":
+        return routes_for(*selected_route()), None
+    providers = [provider for provider, key in api_keys().items() if key]
+    decision = choose_routes(task, count_tokens("gpt-4o", prompt_text), output_tokens, providers)
+    if not decision.routes:
+        raise RetryError([])
+    return decision.routes, describe_routing(decision)
+
+
+def toast_retry(route, error, delay):
+    api_error = st.toast(f"Error: {error}")
+    api_error.toast(f"Retrying {route.model} in {delay:.1f}s...")
+
+
+def toast_failover(route, error):
+    st.toast(f"{route.model} failed ({error}). Trying the next model...")
+
+
+CHAT_TEMPERATURE = {"OpenAI": None, "Claude": 0.5}
+CHAT_RESPONSE_KEYS = ("reply", "cover_letter", "name")
+
+
+def chat_completion(chat_system_prompt, history, user_turn, routes):
+    def attempt(route):
+        client = get_client(route.provider, api_key_for(route.provider))
+        temperature = CHAT_TEMPERATURE[route.provider]
+        if route.provider == "OpenAI":
+            system = {"role": "system", "content": [{"type": "text", "text": chat_system_prompt}]}
+            request_messages = [system] + history + [user_turn]
+            cache_key = response_cache.key(route.provider, route.model, temperature, request_messages)
+            response = response_cache.get(cache_key)
+            if response is None:
+                with span("llm", provider=route.provider, model=route.model):
+                    completion = client.chat.completions.create(
+                        model=route.model,
+                        messages=request_messages,
+                        response_format={"type": "json_object"}
+                    )
+                record_openai_usage(route.model, completion.usage)
+                response = completion.choices[0].message.content
+        else:
+            # same layout as the OpenAI chat: a cached, stable system prompt and the current cover letter last
+            system = [cached_block(chat_system_prompt)]
+            request_messages = history + [user_turn]
+            cache_key = response_cache.key(route.provider, route.model, temperature, system, request_messages)
+            response = response_cache.get(cache_key)
+            if response is None:
+                with span("llm", provider=route.provider, model=route.model):
+                    message = client.messages.create(
+                        system=system,
+                        messages=request_messages,
+                        model=route.model,
                         temperature=temperature,
                         max_tokens=4000
-                    ).content[0].text
-                    response = validate_json(response)
-                    break
-                except Exception as e:
-                    api_error = st.toast(f"Error: {e}")
-                    time.sleep(1)
-                    api_error.toast("Retrying...")
-
+                    )
+                record_claude_usage(route.model, message.usage)
+                response = message.content[0].text
+        parsed = validate_json(response, CHAT_RESPONSE_KEYS)
+        missing = [key for key in CHAT_RESPONSE_KEYS if key not in parsed]
+        if missing:
+            raise KeyError(f"Response is missing {', '.join(missing)}")
+        response_cache.put(cache_key, response)
+        return parsed
+
+    route, response = call_with_retry(routes, attempt, on_retry=toast_retry, on_failover=toast_failover,
+                                      task="chat")
+    return response
+
+
+JOB_POLL_INTERVAL = 1
+
+
+@st.fragment
+def debug_panel():
+    traces = trace_log.for_session(st.session_state.session_id)
+    with st.expander(f"Debug: last {len(traces)} requests"):
+        rows = []
+        for trace in reversed(traces):
+            row = {"request": trace.name, "model": trace.model, "status": trace.status,
+                   "total (s)": round(trace.duration, 2)}
+            row.update({f"{stage} (s)": round(seconds, 2) for stage, seconds in trace.stage_seconds().items()})
+            row["model calls"] = trace.counters.get("llm_attempts_total", 0)
+            row["tokens in"] = trace.counters.get("llm_input_tokens_total", 0)
+            row["tokens out"] = trace.counters.get("llm_output_tokens_total", 0)
+            rows.append(row)
+        if rows:
+            st.dataframe(rows, hide_index=True)
+        else:
+            st.write("No requests yet.")
+
+
+def chat_system_prompt(api_name, cover_letter_prompt, resume, job_title, job_description, about_you):
+    return (f"You are professional resume writer and job application specialist. "
+            f"Your current role is to create a custom cover letter for the user. "
+            f"You can ask the user for more information. "
+            f"You have to respond in JSON format with a 'cover_letter' key containing the "
+            f"updated cover letter, 'reply' key containing your response to user's reply. "
+            f"and a 'name' key containng the name of the cover letter file. Try to name it "
+            f"in a way that it can be easily identified. (eg: coverLetterMananxCompany)"
+            f"Basically its an app where users can edit cover letter side by side via {api_name} API\n"
+            f"Make sure the JSON is properly formatted and escaped. No need to include "
+            f"```json before the start of JSON string. \n"
+            f"Cover letter should be in plain text format. start the letter with"
+            f"something like 'dear hiring manager' or something. No need to use the standard"
+            f"letter format. End it with Thanks,[Name] \n"
+            f"{cover_letter_prompt} \n"
+            f"User Resume: {resume} \n"
+            f"Job Title: {job_title} \n"
+            f"Job Description: {job_description} \n"
+            f"About User: {about_you} \n")
+
+
+def chat_resume():
+    """The resume as the chat sees it, only the entries relevant to the posting."""
+    return prune_resume(st.session_state.latex_input,
+                        f"{st.session_state.job_title}\n{st.session_state.job_description}")
+
+
+def on_generate_resume(latex=None, mode=None):
+    """Submit a generation for the posting on the page; `latex` and `mode` default to the editor's and the radio's."""
     if st.session_state.job_title == "" or st.session_state.job_description == "":
         st.error("Please enter the job title and job description.")
-        # st.stop()
+        return
+
+    mode = mode or st.session_state.generation_mode
+    request = build_request(
+        routes=[],
+        api_keys=api_keys(),
+        latex=latex or st.session_state.latex_input,
+        job_title=st.session_state.job_title,
+        job_description=st.session_state.job_description,
+        about_you=st.session_state.about_you,
+        system_prompt=st.session_state.system_prompt,
+        cover_letter_prompt=st.session_state.cover_letter_system_prompt,
+        mode=mode,
+    )
+    try:
+        if mode == "Section edits":
+            routes, note = task_routes("edits", request.edits_system_prompt + request.context + request.question)
+        else:
+            # the whole resume comes back, plus the cover letter
+            routes, note = task_routes("resume", request.system_prompt + request.context + request.question,
+                                       count_tokens("gpt-4o", request.current_latex) + 600)
+        repair_routes, _ = task_routes("repair", request.current_latex[:6000])
+    except RetryError:
+        st.error("No model is available. Please add an API key.")
+        return
+    request = request._replace(routes=routes, repair_routes=repair_routes)
+    # what the history needs besides the result
+    details = {"job_title": st.session_state.job_title, "company": st.session_state.company,
+               "job_description": st.session_state.job_description,
+               "system_prompt": st.session_state.system_prompt,
+               "cover_letter_prompt": st.session_state.cover_letter_system_prompt}
+    if st.session_state.compare_candidates:
+        job = job_executor.submit(st.session_state.job_title, run_traced_candidates, request, details,
+                                  st.session_state.session_id)
     else:
-        st.toast("Generating resume...")
-        st.session_state.latex_input = response['resume']
-        st.session_state.cover_letter = response['cover_letter']
-        st.session_state.cover_letter_file_name = response['name']
-
-        # Compile the LaTeX code to PDF
-        pdf_path, error = compile_latex(st.session_state.latex_input)
-        if error:
-            st.session_state.pdf_compilation_error = True
-            st.session_state.pdf_compilation_error_message = error
+        job = job_executor.submit(st.session_state.job_title, run_traced_generation, request, details,
+                                  st.session_state.session_id)
+    if note:
+        job.log(note)
+    st.session_state.jobs.append(job)
+    st.toast("Generating resume...")
+
+
+def record_history(result, route, details, session, trace, job, index=True):
+    """Save a finished generation to the history and note its id on the result.
+
+    With `index` its posting is added to the ones checked for reposts.
+    """
+    try:
+        result["history_id"] = history_store.record(
+            session=session, **details, provider=route.provider, model=route.model, latex=result["resume"],
+            cover_letter=result["cover_letter"], cover_letter_name=result["name"], pdf_path=result["pdf_path"],
+            compile_error=result["compile_error"], timings={**trace.stage_seconds(), "total": trace.elapsed})
+        if index:
+            index_posting(history_store, result["history_id"], details["job_description"])
+    except (sqlite3.Error, OSError) as e:
+        # the user still gets the result, it just won't be in the history
+        job.log(f"Couldn't save this to the history ({e}).")
+
+
+def similar_posting(job_description):
+    """The history entry of an earlier posting that is almost the same as `job_description`, with its similarity.
+
+    Nothing is offered when the resume on the page already came from one of them.
+    """
+    if not job_description.strip():
+        return None, None
+    matches = shared_index(history_store).find(signature(job_description))
+    if not matches or st.session_state.history_id in {entry_id for entry_id, _ in matches}:
+        return None, None
+    entry_id, similarity = matches[0]
+    return history_store.get(entry_id), similarity
+
+
+def run_traced_generation(request, details, session, job=None):
+    with traced("generate", session, *request.routes[0]) as trace:
+        result = run_generation(request, job)
+        record_history(result, job.route or request.routes[0], details, session, trace, job)
+        return result
+
+
+def run_traced_candidates(request, details, session, job=None):
+    with traced("generate_candidates", session, *request.routes[0]) as trace:
+        result = run_candidates(request, details["job_description"], parse_candidates(), job)
+        for rank, candidate in enumerate(result["candidates"]):
+            # the other candidates are the same posting, the best one stands for them
+            record_history(candidate, candidate["route"], details, session, trace, job, index=rank == 0)
+        result["history_id"] = result["candidates"][0].get("history_id")
+        return result
+
+
+def apply_job_result(job, result=None):
+    """Load a finished job into the editor and preview; `result` picks one of its candidates."""
+    result = result or job.result
+    st.session_state.history_id = result.get("history_id")
+    st.session_state.history_entries = None
+    st.session_state.pending_latex_input = result['resume']
+    st.session_state.cover_letter = result['cover_letter']
+    st.session_state.cover_letter_file_name = result['name']
+    if result['compile_error']:
+        st.session_state.pdf_compiled = False
+        st.session_state.pdf_compilation_error = True
+        st.session_state.pdf_compilation_error_message = result['compile_error']
+    else:
+        st.session_state.pdf_url = pdf_url(result['pdf_path'], request_host())
+        st.session_state.pdf_compiled = True
+    job.applied = True
+
+
+def candidates_table(job):
+    with st.expander(f"{len(job.result['candidates'])} candidates, best first"):
+        for index, candidate in enumerate(job.result["candidates"]):
+            info_col, load_col = st.columns([3, 1])
+            with info_col:
+                st.caption(f"{candidate['route'].model} · temperature {candidate['temperature']} · "
+                           f"score {candidate['score']} · {candidate['coverage']:.0%} of keywords · "
+                           f"{candidate['pages'] or '?'} page(s)"
+                           f"{'' if candidate['pdf_path'] else ' · did not compile'}")
+            with load_col:
+                if st.button("Load", key=f"load_candidate_{job.id}_{index}"):
+                    apply_job_result(job, candidate)
+                    st.rerun()
+
+
+def restore_history(entry_id):
+    """Load a saved generation into the editor, preview, cover letter and chat, without calling a model."""
+    entry = history_store.get(entry_id)
+    if entry is None:
+        st.toast("That entry is no longer in the history.")
+        return
+    st.session_state.pending_latex_input = entry["latex"]
+    st.session_state.cover_letter = entry["cover_letter"]
+    st.session_state.cover_letter_file_name = entry["cover_letter_name"]
+    for provider, chat in (entry["chat"] or {}).items():
+        st.session_state.chat_histories[provider] = ChatHistory.from_dict(chat)
+    pdf_path = history_store.restore_pdf(entry)
+    if pdf_path is not None:
+        st.session_state.pdf_url = pdf_url(pdf_path, request_host())
+        st.session_state.pdf_compiled = True
+        st.session_state.pdf_compilation_error = False
+    else:
+        st.session_state.pdf_compiled = False
+        st.session_state.pdf_compilation_error = True
+        st.session_state.pdf_compilation_error_message = entry["compile_error"] or "The PDF is not in the history."
+    st.session_state.history_id = entry_id
+
+
+@st.fragment
+def history_sidebar():
+    st.markdown("##### History")
+    search = st.text_input("Search the history", placeholder="Search job titles, companies and descriptions",
+                           label_visibility="collapsed")
+    # entries are fetched a page at a time and kept until the search changes or a new generation comes in
+    if st.session_state.history_entries is None or st.session_state.get("history_search") != search:
+        st.session_state.history_search = search
+        st.session_state.history_entries = history_store.page(search)
+        st.session_state.history_more = len(st.session_state.history_entries) == HISTORY_PAGE_SIZE
+
+    entries = st.session_state.history_entries
+    if not entries:
+        st.caption("Nothing here yet." if not search else "No matches.")
+    for entry in entries:
+        with st.container(border=True):
+            company = f" · {entry['company']}" if entry["company"] else ""
+            st.markdown(f"**{entry['job_title']}**{company}")
+            st.caption(f"{time.strftime('%b %d, %H:%M', time.localtime(entry['created']))} · {entry['model']}"
+                       f"{'' if entry['compiled'] else ' · did not compile'}")
+            if st.button("Restore", key=f"restore_history_{entry['id']}"):
+                restore_history(entry["id"])
+                st.rerun()
+    if st.session_state.history_more and st.button("Load more", key="history_load_more"):
+        more = history_store.page(search, before=entries[-1]["id"])
+        st.session_state.history_more = len(more) == HISTORY_PAGE_SIZE
+        entries.extend(more)
+        st.rerun(scope="fragment")
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def job_panel():
+    jobs = st.session_state.jobs
+    if not jobs:
+        return
+
+    # the newest job loads itself into the editor as soon as it is done, older ones wait for 'Load'
+    latest = jobs[-1]
+    if latest.stage == "done" and not latest.applied:
+        apply_job_result(latest)
+        st.rerun()
+
+    for job in reversed(jobs):
+        with st.container(border=True):
+            status_col, action_col = st.columns([3, 1])
+            with status_col:
+                st.markdown(f"**{job.label}** · {job.stage} · {job.elapsed:.0f}s")
+                for message in job.messages[-2:]:
+                    st.caption(message)
+                # what the model has written so far, updated every poll while it streams
+                if job.active and job.partial is not None and "resume" in job.partial.fields:
+                    with st.expander("Resume so far"):
+                        st.code(job.partial.get("resume"), language="latex")
+                if job.active and job.partial is not None and "cover_letter" in job.partial.fields:
+                    with st.expander("Cover letter so far"):
+                        st.text(job.partial.get("cover_letter"))
+                if job.stage == "failed":
+                    st.error(f"Couldn't generate the resume. {job.error}")
+                if job.stage == "done" and len(job.result.get("candidates", [])) > 1:
+                    candidates_table(job)
+            with action_col:
+                if job.active:
+                    if st.button("Cancel", key=f"cancel_job_{job.id}"):
+                        job.cancel()
+                elif job.stage == "done" and st.button("Load", key=f"load_job_{job.id}"):
+                    apply_job_result(job)
+                    st.rerun()
+                elif st.button("Dismiss", key=f"dismiss_job_{job.id}"):
+                    jobs.remove(job)
+                    st.rerun(scope="fragment")
+
+
+@st.fragment
+def chat_panel():
+    provider = st.session_state.ai_model
+    chat_history = st.session_state.chat_histories[provider]
+
+    history = st.container(height=400)
+    with history:
+        if len(chat_history) == 0:
+            st.write("No messages yet. Here you can chat with the AI model. and it can update your cover letter"
+                     " accordingly. \n\n"
+                     "P.S: DO NOT change the company (OpenAI/Claude) in the middle of the conversation. It "
+                     "won't transfer the chats. It will start a new conversation. "
+                     "You can change the models though.")
+        for message in chat_history.messages:
+            with st.chat_message(message["role"]):
+                st.write(message["content"][0]["text"])
+    # # Chatbot for cover letter generation
+    prompt = st.chat_input("Write a message... (Only for cover letter generation)")
+    if prompt:
+        # the system prompt only changes with the resume/job, so it stays a stable prefix for prompt
+        # caching; each message only carries the current cover letter. Built only when a message is sent,
+        # pruning the resume takes a while
+        chat_context = chat_system_prompt({"OpenAI": "GPT", "Claude": "Claude"}.get(provider, "AI"),
+                                          st.session_state.cover_letter_system_prompt, chat_resume(),
+                                          st.session_state.job_title, st.session_state.job_description,
+                                          st.session_state.about_you)
+        user_turn = {"role": "user", "content": [
+            {
+                "type": "text",
+                "text": f"Current Cover Letter: {st.session_state.cover_letter} \n"
+            },
+            {
+                "type": "text",
+                "text": prompt
+            }
+        ]}
+        try:
+            routes, _ = task_routes("chat", chat_context + message_text(user_turn))
+            with traced("chat", st.session_state.session_id, *routes[0]):
+                past_turns = chat_history.prompt_messages(routes[0].model, routes, api_keys())
+                response = chat_completion(chat_context, past_turns, user_turn, routes)
+        except RetryError as e:
+            st.error(f"Couldn't update the cover letter. {e}")
         else:
-            pdf_base64 = pdf_to_base64(pdf_path)
-            st.session_state.pdf_display = (f'<iframe src="data:application/pdf;base64,{pdf_base64}" width="100%" '
-                                            f'height="1164" type="application/pdf"></iframe>')
-            st.session_state.pdf_compiled = True
-            # remove temporary files
-            os.remove("temp.pdf")
-            os.remove("temp.tex")
-            for aux_file in ["temp.aux", "temp.log"]:
-                if os.path.exists(aux_file):
-                    os.remove(aux_file)
+            chat_history.append(prompt, response["reply"])
+            st.session_state.cover_letter = response["cover_letter"]
+            st.session_state.cover_letter_file_name = response["name"]
+            if st.session_state.history_id is not None:
+                chats = {name: history.to_dict() for name, history in st.session_state.chat_histories.items()
+                         if len(history)}
+                history_store.update_chat(st.session_state.history_id, chats, response["cover_letter"],
+                                          response["name"])
+            # the new letter goes into the cover letter panel, which is outside this fragment
+            st.rerun()
+
+
+@st.fragment
+def cover_letter_panel():
+    st.markdown("##### Cover Letter")
+
+
+    file_name = st.session_state.cover_letter_file_name
+    cover_letter_text = st.text_area("Cover Letter", height=360, label_visibility="collapsed",
+                                     placeholder="Cover Letter will be generated here.",
+                                     value=st.session_state.cover_letter)
+    cover_letter_text = cover_letter_text.replace("’", "'")
 
+    st.download_button(
+        label="Save Cover Letter (PDF)",
+        data=pdf_renderer(cover_letter_text),
+        file_name=f"{file_name}.pdf",
+        mime="application/pdf"
+    )
+
+    st.write("If you're making edits, click outside the text area to save your changes, and then download the PDF.")
+
+
+with st.sidebar:
+    history_sidebar()
 
 with (col_main):
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("##### Choose your AI model")
-        st.session_state.ai_model = st.selectbox("Select the LLM", ["Claude", "OpenAI"], label_visibility="collapsed")
+        st.session_state.ai_model = st.selectbox(
+            "Select the LLM", ["Claude", "OpenAI", "Auto"], label_visibility="collapsed",
+            help="'Auto' picks the model for every request: a cheap, fast one for chat and small edits, a strong "
+                 "one for rewriting the whole resume, within ROUTER_MAX_COST and ROUTER_MAX_LATENCY.")
         st.markdown("##### Enter your API key")
-        if st.session_state.ai_model == "OpenAI":
+        if st.session_state.ai_model == "Auto":
+            st.caption("Uses the OpenAI and Claude API keys you entered, or the ones in your .env file.")
+        elif st.session_state.ai_model == "OpenAI":
             st.session_state.openai_api_key = st.text_input(f"Enter your OpenAI API key here", type="password",
                                                             label_visibility="collapsed",
                                                             value=os.environ["OPENAI_API_KEY"])
@@ -304,6 +640,8 @@ with (col_main):
         st.session_state.job_title = st.text_input("Enter the job title here"
                                                    , label_visibility="collapsed",
                                                    placeholder="Enter the job title here.")
+        st.session_state.company = st.text_input("Company", label_visibility="collapsed",
+                                                 placeholder="Company (optional, for finding it in the history)")
         # st.markdown("##### Job Description")
         st.session_state.job_description = st.text_area("Enter the job description here", height=300,
                                                         placeholder="Enter the job description here.",
@@ -312,178 +650,47 @@ with (col_main):
                                                   placeholder="Something about you that you want to include in the "
                                                               "resume/cover letter/tell the AI.")
 
-        # if st.button("Generate Resume and cover letter"):
-        st.button("Generate Resume and cover letter", on_click=on_generate_resume)
-
-        if st.session_state.ai_model == "OpenAI":
-
-            if "messages" not in st.session_state:
-                st.session_state.messages = messages = [
-                    {
-                        "role": "system",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"You are professional resume writer and job application specialist. "
-                                        f"Your current role is to create a custom cover letter for the user. "
-                                        f"You can ask the user for more information. "
-                                        f"You have to respond in JSON format with a 'cover_letter' key containing the "
-                                        f"updated cover letter. and 'reply' key containing your response to user's reply."
-                                        f"Basically its an app where users can edit cover letter side by side via GPT API\n"
-                                        f"Make sure the JSON is properly formatted and escaped. No need to include "
-                                        f"```json before the start of JSON string. \n"
-                                        f"Cover letter should be in plain text format. start the letter with"
-                                        f"something like 'dear hiring manager' or something. No need to use the standard"
-                                        f"letter format. End it with Thanks,[Name] \n"
-                                        f"{st.session_state.cover_letter_system_prompt} \n"
-                                        f"User Resume: {st.session_state.latex_input} \n"
-                                        f"Job Title: {st.session_state.job_title} \n"
-                                        f"Job Description: {st.session_state.job_description} \n"
-                                        f"About User: {st.session_state.about_you} \n"
-                                        f"Current Cover Letter: {st.session_state.cover_letter} \n"
-                            }
-                        ]
-                    }
-                ]
-
-            st.session_state.messages[0]["content"][0]["text"] = (
-                f"You are professional resume writer and job application specialist. "
-                f"Your current role is to create a custom cover letter for the user. "
-                f"You can ask the user for more information. "
-                f"You have to respond in JSON format with a 'cover_letter' key containing the "
-                f"updated cover letter, 'reply' key containing your response to user's reply. "
-                f"and a 'name' key containng the name of the cover letter file. Try to name it "
-                f"in a way that it can be easily identified. (eg: coverLetterMananxCompany)"
-                f"Basically its an app where users can edit cover letter side by side via GPT API\n"
-                f"Make sure the JSON is properly formatted and escaped. No need to include "
-                f"```json before the start of JSON string. \n"
-                f"Cover letter should be in plain text format. start the letter with"
-                f"something like 'dear hiring manager' or something. No need to use the standard"
-                f"letter format. End it with Thanks,[Name] \n"
-                f"{st.session_state.cover_letter_system_prompt} \n"
-                f"User Resume: {st.session_state.latex_input} \n"
-                f"Job Title: {st.session_state.job_title} \n"
-                f"Job Description: {st.session_state.job_description} \n"
-                f"About User: {st.session_state.about_you} \n"
-                f"Current Cover Letter: {st.session_state.cover_letter} \n")
-
-            client = OpenAI(api_key=st.session_state.openai_api_key)
-
-            history = st.container(height=400)
-            with history:
-                if len(st.session_state.messages) == 1:
-                    st.write("No messages yet. Here you can chat with the AI model. and it can update your cover letter"
-                             " accordingly. \n\n"
-                             "P.S: DO NOT change the company (OpenAI/Claude) in the middle of the conversation. It "
-                             "won't transfer the chats. It will start a new conversation. "
-                             "You can change the models though.")
-                for message in st.session_state.messages[1:]:
-                    if message["role"] == "user":
-                        with st.chat_message("user"):
-                            st.write(message["content"][0]["text"])
-                    if message["role"] == "assistant":
-                        with st.chat_message("assistant"):
-                            st.write(message["content"][0]["text"])
-            # # Chatbot for cover letter generation
-            prompt = st.chat_input("Write a message... (Only for cover letter generation)")
-            if prompt:
-                # print(st.session_state.messages)
-                response = client.chat.completions.create(
-                    model=st.session_state.openai_model_name,
-                    messages=st.session_state.messages,
-                    response_format={"type": "json_object"}
-                )
-                st.session_state.messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
-                st.session_state.messages.append({"role": "assistant", "content": [
-                    {
-                        "type": "text",
-                        "text": json.loads(response.choices[0].message.content)["reply"]
-                    }
-                ]})
-                st.session_state.cover_letter = json.loads(response.choices[0].message.content)["cover_letter"]
-                st.session_state.cover_letter_file_name = json.loads(response.choices[0].message.content)["name"]
-                st.rerun()
-
-        if st.session_state.ai_model == "Claude":
-            # st.error("Claude is not yet supported. Please select OpenAI as the AI model. "
-            #          "(or contribute to the project)")
-            # st.stop()
-            claude_chat_prompt = (
-                f"You are professional resume writer and job application specialist. "
-                f"Your current role is to create a custom cover letter for the user. "
-                f"You can ask the user for more information. "
-                f"You have to respond in JSON format with a 'cover_letter' key containing the "
-                f"updated cover letter, 'reply' key containing your response to user's reply. "
-                f"and a 'name' key containng the name of the cover letter file. Try to name it "
-                f"in a way that it can be easily identified. (eg: coverLetterMananxCompany)"
-                f"Basically its an app where users can edit cover letter side by side via Claude API\n"
-                f"Make sure the JSON is properly formatted and escaped. No need to include "
-                f"```json before the start of JSON string. \n"
-                f"Cover letter should be in plain text format. start the letter with"
-                f"something like 'dear hiring manager' or something. No need to use the standard"
-                f"letter format. End it with Thanks,[Name] \n"
-                f"{st.session_state.cover_letter_system_prompt} \n"
-                f"User Resume: {st.session_state.latex_input} \n"
-                f"Job Title: {st.session_state.job_title} \n"
-                f"Job Description: {st.session_state.job_description} \n"
-                f"About User: {st.session_state.about_you} \n"
-                f"Current Cover Letter: {st.session_state.cover_letter} \n")
-
-            history = st.container(height=400)
-            if "claude_messages" not in st.session_state:
-                st.session_state.claude_messages = []
-            with history:
-                if len(st.session_state.claude_messages) == 0:
-                    st.write("No messages yet. Here you can chat with the AI model. and it can update your cover letter"
-                             " accordingly. \n\n"
-                             "P.S: DO NOT change the company (OpenAI/Claude) in the middle of the conversation. It "
-                             "won't transfer the chats. It will start a new conversation. "
-                             "You can change the models though.")
-
-                for message in st.session_state.claude_messages:
-                    if message["role"] == "user":
-                        with st.chat_message("user"):
-                            st.write(message["content"][0]["text"])
-                    if message["role"] == "assistant":
-                        with st.chat_message("assistant"):
-                            st.write(message["content"][0]["text"])
-
-            prompt = st.chat_input("Write a message... (Only for cover letter generation)")
-
-            if prompt:
-
-                client = Anthropic()
-                for i in range(5):
-                    try:
-                        response = client.messages.create(
-                            system=claude_chat_prompt,
-                            messages=st.session_state.claude_messages,
-                            model=st.session_state.claude_model_name,
-                            temperature=0.5,
-                            max_tokens=4000
-                        ).content[0].text
-                        # print(response)
-                        response = validate_json(response)
-                        break
-                    except Exception as e:
-                        api_error = st.toast(f"Error: {e}")
-                        time.sleep(1)
-                        api_error.toast(f"Retrying...{e}")
-                st.session_state.claude_messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
-                st.session_state.claude_messages.append({"role": "assistant", "content": [
-                    {
-                        "type": "text",
-                        "text": response['reply']
-                    }
-                ]})
-                st.session_state.cover_letter = response["cover_letter"]
-                st.session_state.cover_letter_file_name = response["name"]
-                st.rerun()
+        earlier, similarity = similar_posting(st.session_state.job_description)
+        if earlier is not None:
+            company = f" at {earlier['company']}" if earlier["company"] else ""
+            st.info(f"You already tailored your resume for an almost identical posting ({similarity:.0%} alike): "
+                    f"**{earlier['job_title']}**{company} on "
+                    f"{time.strftime('%b %d', time.localtime(earlier['created']))}.")
+            reuse_col, edit_col = st.columns(2)
+            with reuse_col:
+                if st.button("Use that resume and cover letter", help="Loads them without calling the model."):
+                    restore_history(earlier["id"])
+                    st.rerun()
+            with edit_col:
+                if st.button("Start from it", help="Asks the model only for the edits this posting needs, "
+                                                   "starting from that resume."):
+                    on_generate_resume(latex=earlier["latex"], mode="Section edits")
+
+        st.session_state.generation_mode = st.radio("Generation mode", ["Full resume", "Section edits"],
+                                                    horizontal=True,
+                                                    help="'Section edits' asks the model only for the changed "
+                                                         "sections/items and patches them into your resume, which is "
+                                                         "much faster. It falls back to a full rewrite if the edits "
+                                                         "don't apply.")
+        st.session_state.compare_candidates = st.toggle(
+            "Compare models", disabled=not GENERATION_CANDIDATES,
+            help="Generate a resume with each model in GENERATION_CANDIDATES at the same time and show the one "
+                 "covering the most job keywords on the fewest pages first.")
+        if st.button("Generate Resume and cover letter"):
+            on_generate_resume()
+        job_panel()
+
+        chat_panel()
+
+        if METRICS_DEBUG_PANEL:
+            debug_panel()
 
     with col2:
         # Ask for model name
         st.markdown("##### Model Name (for generating cover letter)")
-        if st.session_state.ai_model == "OpenAI":
+        if st.session_state.ai_model == "Auto":
+            st.caption("Picked for each request by its size, cost and how fast the models have been lately.")
+        elif st.session_state.ai_model == "OpenAI":
             st.session_state.openai_model_name = st.selectbox("Select OpenAI model", ["gpt-4o", "gpt-3.5-turbo",
                                                                                       "gpt-4o-mini",
                                                                                       "gpt-4-turbo", "gpt-4"]
@@ -516,51 +723,7 @@ with (col_main):
             st.toast("System Prompt updated successfully.")
             time.sleep(1)
             st.rerun()
-        st.markdown("##### Cover Letter")
-
-
-        class PDF(FPDF):
-            def header(self):
-                pass
-
-
-        file_name = st.session_state.cover_letter_file_name
-        cover_letter_text = st.text_area("Cover Letter", height=360, label_visibility="collapsed",
-                                         placeholder="Cover Letter will be generated here.",
-                                         value=st.session_state.cover_letter)
-        cover_letter_text = cover_letter_text.replace("’", "'")
-
-        pdf = PDF()
-        pdf.add_page()
-
-        pdf.set_font("Times", size=11)
-        pdf.set_left_margin(20)
-        pdf.set_right_margin(20)
-        pdf.set_top_margin(20)
-        pdf.set_auto_page_break(auto=True, margin=20)
-
-        paragraphs = cover_letter_text.split('\n\n')
-
-        for paragraph in paragraphs:
-            pdf.multi_cell(0, 5, paragraph.strip(), align='L')
-            pdf.ln(5)
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmpfile:
-            pdf.output(tmpfile.name)
-
-        with open(tmpfile.name, "rb") as f:
-            pdf_data = f.read()
-
-        os.unlink(tmpfile.name)
-
-        st.download_button(
-            label="Save Cover Letter (PDF)",
-            data=pdf_data,
-            file_name=f"{file_name}.pdf",
-            mime="application/pdf"
-        )
-
-        st.write("If you're making edits, click outside the text area to save your changes, and then download the PDF.")
+        cover_letter_panel()
 
 ############################################
 # ########### FOOTER #######################
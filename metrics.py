@@ -0,0 +1,261 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache",
+                                                         "metrics"))
+# one JSON line per finished request, with its spans; empty to turn the trace log off
+METRICS_TRACE_FILE = os.environ.get("METRICS_TRACE_FILE", os.path.join(METRICS_DIR, "trace.jsonl"))
+# Prometheus text written after every request, for node_exporter's textfile collector; empty (default) to skip
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+METRICS_RECENT = int(os.environ.get("METRICS_RECENT", "20"))
+# show the timings of this session's last METRICS_RECENT requests under the chat
+METRICS_DEBUG_PANEL = os.environ.get("METRICS_DEBUG_PANEL", "0") == "1"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class Registry:
+    """Process-wide counters and latency histograms, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, value) for key, value in labels.items() if value is not None))
+
+    def count(self, name, value=1, help=None, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            if help:
+                self._help.setdefault(name, help)
+
+    def observe(self, name, seconds, help=None, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+            if help:
+                self._help.setdefault(name, help)
+
+    def render(self, extra_counters=()):
+        """The metrics in the Prometheus text exposition format.
+
+        `extra_counters` are `(name, labels, value)` tuples owned by other modules, like the JSON parse stats.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items()) + sorted(((name, tuple(sorted(labels.items()))), value)
+                                                               for name, labels, value in extra_counters)
+            histograms = sorted((key, (list(buckets), count, total))
+                                for key, (buckets, count, total) in self._histograms.items())
+            help_texts = dict(self._help)
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                if name in help_texts:
+                    lines.append(f"# HELP {name} {help_texts[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_label_text(labels)} {value:g}")
+        for (name, labels), (buckets, count, total) in histograms:
+            if name not in seen:
+                seen.add(name)
+                if name in help_texts:
+                    lines.append(f"# HELP {name} {help_texts[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', f'{bound:g}'),))} {bucket_count}")
+            lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_label_text(labels)} {total:g}")
+            lines.append(f"{name}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Trace:
+    """Timings and token counts of one user-facing request: a generation or a chat message."""
+
+    def __init__(self, name, session=None, provider=None, model=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.session = session
+        self.provider = provider
+        self.model = model
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, seconds, **attributes):
+        with self._lock:
+            self.spans.append({"name": name, "start": round(start - self._clock, 4), "seconds": round(seconds, 4),
+                               **attributes})
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @property
+    def elapsed(self):
+        return self.duration if self.duration is not None else time.perf_counter() - self._clock
+
+    def stage_seconds(self):
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0) + span["seconds"]
+        return totals
+
+    def as_dict(self):
+        return {"id": self.id, "name": self.name, "session": self.session, "provider": self.provider,
+                "model": self.model, "started": self.started, "seconds": self.duration, "status": self.status,
+                "spans": self.spans, "counters": self.counters}
+
+
+class TraceLog:
+    """Keeps the last few finished traces of every session and appends each one to the JSONL trace file."""
+
+    def __init__(self, path, recent):
+        self.path = path
+        self.recent = recent
+        self._sessions = {}
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def record(self, trace):
+        line = json.dumps(trace.as_dict(), default=str)
+        with self._lock:
+            self._sessions.setdefault(trace.session, deque(maxlen=self.recent)).append(trace)
+            if self.path:
+                with open(self.path, "a") as trace_file:
+                    trace_file.write(line + "\n")
+
+    def for_session(self, session):
+        with self._lock:
+            return list(self._sessions.get(session, ()))
+
+
+trace_log = TraceLog(METRICS_TRACE_FILE, METRICS_RECENT)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace():
+    return _current.get()
+
+
+def finish_trace(trace, status="ok"):
+    trace.duration = time.perf_counter() - trace._clock
+    trace.status = status
+    registry.observe("resume_request_seconds", trace.duration, help="End to end latency of user requests",
+                     request=trace.name, provider=trace.provider, model=trace.model, status=status)
+    trace_log.record(trace)
+    if METRICS_FILE:
+        write_metrics_file(METRICS_FILE)
+
+
+@contextmanager
+def traced(name, session=None, provider=None, model=None):
+    """Run the block under a new trace, finished as ok, error or cancelled when the block exits."""
+    trace = Trace(name, session, provider, model)
+    token = _current.set(trace)
+    status = "cancelled"
+    try:
+        yield trace
+        status = "ok"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _current.reset(token)
+        finish_trace(trace, status)
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time the block as `stage`, in the stage histogram and in the current trace if there is one."""
+    trace = current_trace()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if trace is not None:
+            labels.setdefault("provider", trace.provider)
+            labels.setdefault("model", trace.model)
+            trace.add_span(stage, start, seconds, **{key: value for key, value in labels.items()
+                                                     if key not in ("provider", "model")})
+        registry.observe("resume_stage_seconds", seconds, help="Time spent per stage", stage=stage, **labels)
+
+
+def observe(stage, seconds, **labels):
+    """Record a stage that was timed elsewhere, e.g. time to first token."""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_span(stage, time.perf_counter() - seconds, seconds)
+        labels.setdefault("provider", trace.provider)
+        labels.setdefault("model", trace.model)
+    registry.observe("resume_stage_seconds", seconds, help="Time spent per stage", stage=stage, **labels)
+
+
+def count(name, value=1, help=None, **labels):
+    """Add to a process-wide counter, and to the current trace's counters."""
+    trace = current_trace()
+    if trace is not None:
+        trace.add(name, value)
+    registry.count(name, value, help=help, **labels)
+
+
+def record_tokens(provider, model, input_tokens, output_tokens, cached_tokens=0):
+    count("llm_input_tokens_total", input_tokens or 0, help="Prompt tokens sent", provider=provider, model=model)
+    count("llm_output_tokens_total", output_tokens or 0, help="Tokens generated", provider=provider, model=model)
+    if cached_tokens:
+        count("llm_cached_input_tokens_total", cached_tokens, help="Prompt tokens read from the provider's cache",
+              provider=provider, model=model)
+
+
+def render():
+    # imported here so the JSON parser doesn't have to know about metrics
+    from json_extract import parse_stats
+    extra = [("json_parse_total", {"outcome": outcome}, value)
+             for outcome, value in parse_stats.snapshot().items() if outcome != "total"]
+    return registry.render(extra)
+
+
+def write_metrics_file(path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as metrics_file:
+        metrics_file.write(render())
+    os.replace(tmp_path, path)
@@ -0,0 +1,122 @@
+import os
+import re
+import threading
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+# postings at least this similar (estimated Jaccard similarity of their word 3-grams) count as the same job
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", "0.8"))
+
+MINHASH_PERMUTATIONS = 128
+# 16 bands of 8 rows put the LSH threshold at about 0.7, so postings above DUPLICATE_THRESHOLD are rarely missed
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+SHINGLE_WORDS = 3
+
+_PRIME = np.uint64((1 << 31) - 1)
+_random = np.random.default_rng(20240714)
+_A = _random.integers(1, int(_PRIME), MINHASH_PERMUTATIONS, dtype=np.uint64)
+_B = _random.integers(0, int(_PRIME), MINHASH_PERMUTATIONS, dtype=np.uint64)
+_WORD = re.compile(r"\w+")
+
+
+def shingles(text):
+    """Hashes of the overlapping word 3-grams of `text`, ignoring case, punctuation and spacing."""
+    words = _WORD.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[index:index + SHINGLE_WORDS]) for index in range(len(words) - SHINGLE_WORDS + 1)]
+    return np.fromiter({zlib.crc32(gram.encode("utf-8")) for gram in grams}, dtype=np.uint64)
+
+
+@lru_cache(maxsize=64)
+def signature(text):
+    """MinHash signature of a posting: for each of the hash permutations, the smallest hash of its shingles."""
+    hashes = shingles(text) % _PRIME
+    if not len(hashes):
+        return np.full(MINHASH_PERMUTATIONS, _PRIME, dtype=np.uint32)
+    # values stay below 2**63, so the multiply can't overflow
+    permuted = (_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME
+    signature = permuted.min(axis=1).astype(np.uint32)
+    signature.flags.writeable = False
+    return signature
+
+
+class PostingIndex:
+    """Locality-sensitive hashing index over the MinHash signatures of tailored postings.
+
+    A signature is split into bands and each band is a dictionary key, so a lookup only compares
+    against postings that share a whole band, which takes about the same time however many postings
+    there are. Keys are history entry ids.
+    """
+
+    def __init__(self, threshold=DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self._bands = [{} for _ in range(LSH_BANDS)]
+        self._signatures = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def add(self, key, posting_signature):
+        with self._lock:
+            self._signatures[key] = posting_signature
+            for band, bucket in zip(self._bands, self._band_keys(posting_signature)):
+                band.setdefault(bucket, []).append(key)
+
+    @staticmethod
+    def _band_keys(posting_signature):
+        return [posting_signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes() for band in range(LSH_BANDS)]
+
+    def find(self, posting_signature, threshold=None):
+        """`(key, similarity)` of the indexed postings at least `threshold` similar, most similar first."""
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            candidates = {key for band, bucket in zip(self._bands, self._band_keys(posting_signature))
+                          for key in band.get(bucket, ())}
+            if not candidates:
+                return []
+            keys = list(candidates)
+            stacked = np.stack([self._signatures[key] for key in keys])
+        similarities = (stacked == posting_signature).mean(axis=1)
+        matches = [(key, float(similarity)) for key, similarity in zip(keys, similarities) if similarity >= threshold]
+        return sorted(matches, key=lambda match: (-match[1], -match[0]))
+
+
+def load_index(store, threshold=DUPLICATE_THRESHOLD):
+    """Build the index from the signatures saved in the history, computing any that are missing."""
+    index = PostingIndex(threshold)
+    for key, blob in store.signatures():
+        index.add(key, np.frombuffer(blob, dtype=np.uint32))
+    for key, job_description in store.unsigned_postings():
+        posting_signature = signature(job_description)
+        store.save_signature(key, posting_signature.tobytes())
+        index.add(key, posting_signature)
+    return index
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_index(store):
+    """The index of `store`, loaded on first use and then kept up to date with `index_posting`.
+
+    One per process, shared by every session and background job.
+    """
+    with _shared_lock:
+        index = _shared.get(store)
+        if index is None:
+            index = _shared[store] = load_index(store)
+        return index
+
+
+def index_posting(store, entry_id, job_description):
+    """Save the signature of a new history entry's posting and add it to the shared index."""
+    posting_signature = signature(job_description)
+    store.save_signature(entry_id, posting_signature.tobytes())
+    shared_index(store).add(entry_id, posting_signature)
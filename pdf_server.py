@@ -0,0 +1,103 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from latex_compiler import cache
+from metrics import render as render_metrics
+
+PDF_SERVER_HOST = os.environ.get("PDF_SERVER_HOST", "0.0.0.0")
+PDF_SERVER_PORT = int(os.environ.get("PDF_SERVER_PORT", "8502"))
+# set this when the app runs behind a proxy or over https, e.g. https://resume.example.com/pdf
+PDF_BASE_URL = os.environ.get("PDF_BASE_URL", "")
+
+PDF_NAME = re.compile(r"[0-9a-f]{64}\.pdf")
+
+
+class PdfHandler(BaseHTTPRequestHandler):
+    """Serves compiled PDFs straight from the compile cache, and the app's metrics at `/metrics`.
+
+    File names are the hash of the LaTeX source, so a URL always refers to the same bytes and
+    browsers may cache it forever.
+    """
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body):
+        if self.path.split("?", 1)[0] == "/metrics":
+            self._serve_metrics(send_body)
+            return
+        name = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        if not PDF_NAME.fullmatch(name):
+            self.send_error(404)
+            return
+        etag = f'"{name[:-4]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        # going through the cache also marks the entry as recently used
+        pdf_path = (cache.get(name[:-4]) or (None, None))[0]
+        try:
+            with open(pdf_path, "rb") as pdf_file:
+                data = pdf_file.read()
+        except (TypeError, FileNotFoundError):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Content-Disposition", "inline")
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def _serve_metrics(self, send_body):
+        data = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_lock = threading.Lock()
+
+
+def ensure_server():
+    """Start the PDF server once per process; a no-op if it is already running."""
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((PDF_SERVER_HOST, PDF_SERVER_PORT), PdfHandler)
+        except OSError:
+            # another app process on this machine is already serving the same cache directory
+            _server = False
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="pdf-server", daemon=True).start()
+
+
+def pdf_url(pdf_path, host=None):
+    """URL of a compiled PDF; `host` is the hostname the browser used to reach the app."""
+    name = os.path.basename(pdf_path)
+    if PDF_BASE_URL:
+        return f"{PDF_BASE_URL.rstrip('/')}/{name}"
+    return f"http://{host or 'localhost'}:{PDF_SERVER_PORT}/{name}"
@@ -0,0 +1,89 @@
+import re
+
+SECTION_PATTERN = re.compile(r"\\section\*?\{([^}]*)\}")
+END_DOCUMENT = "\\end{document}"
+
+
+class PatchError(ValueError):
+    pass
+
+
+def split_sections(latex_code):
+    """Return `{title: (start, end)}` for every `\\section` of the document.
+
+    A section runs from just after its heading to the next heading or `\\end{document}`.
+    """
+    matches = list(SECTION_PATTERN.finditer(latex_code))
+    document_end = latex_code.rfind(END_DOCUMENT)
+    if document_end == -1:
+        document_end = len(latex_code)
+
+    sections = {}
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else document_end
+        sections[_normalize_title(match.group(1))] = (match.end(), end)
+    return sections
+
+
+def apply_edits(latex_code, edits):
+    """Apply model edits to `latex_code` and return the patched document.
+
+    Each edit either replaces a whole section (`{"section": title, "latex": body}`) or a snippet
+    inside it (`{"find": old, "replace": new}`). Snippets have to match exactly one place in the
+    document, ignoring differences in whitespace. Raises `PatchError` when an edit can't be applied
+    so the caller can fall back to regenerating the full resume.
+    """
+    if not isinstance(edits, list):
+        raise PatchError("'edits' must be a list")
+
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise PatchError(f"Invalid edit: {edit!r}")
+        if "section" in edit:
+            _check_strings(edit, "section", "latex")
+            latex_code = _replace_section(latex_code, edit["section"], edit.get("latex", ""))
+        elif "find" in edit:
+            _check_strings(edit, "find", "replace")
+            latex_code = _replace_snippet(latex_code, edit["find"], edit.get("replace", ""))
+        else:
+            raise PatchError(f"Edit needs a 'section' or a 'find' key: {edit!r}")
+    return latex_code
+
+
+def _check_strings(edit, *keys):
+    # the model sometimes sends null or a list where text belongs
+    for key in keys:
+        if not isinstance(edit.get(key, ""), str):
+            raise PatchError(f"'{key}' must be a string: {edit!r}")
+
+
+def _normalize_title(title):
+    return " ".join(title.split()).lower()
+
+
+def _replace_section(latex_code, title, body):
+    sections = split_sections(latex_code)
+    span = sections.get(_normalize_title(title))
+    if span is None:
+        raise PatchError(f"Section not found: {title!r}")
+    start, end = span
+    return latex_code[:start] + "\n" + body.strip("\n") + "\n\n" + latex_code[end:]
+
+
+def _replace_snippet(latex_code, find, replace):
+    if not find.strip():
+        raise PatchError("Empty 'find' snippet")
+
+    count = latex_code.count(find)
+    if count == 1:
+        return latex_code.replace(find, replace, 1)
+    if count > 1:
+        raise PatchError(f"Snippet matches {count} places: {find[:80]!r}")
+
+    # the model often reflows lines, so retry treating any run of whitespace as equal
+    pattern = re.compile(r"\s+".join(re.escape(word) for word in find.split()))
+    matches = list(pattern.finditer(latex_code))
+    if len(matches) != 1:
+        raise PatchError(f"Snippet matches {len(matches)} places: {find[:80]!r}")
+    match = matches[0]
+    return latex_code[:match.start()] + replace + latex_code[match.end():]
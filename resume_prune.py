@@ -0,0 +1,189 @@
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+from pylatexenc.latex2text import LatexNodes2Text
+from pylatexenc.latexwalker import LatexEnvironmentNode, LatexMacroNode, LatexWalker
+
+from latex_compiler import split_preamble
+
+# the master resume is only pruned when it is larger than this many tokens (0 never prunes)
+RESUME_TOKEN_BUDGET = int(os.environ.get("RESUME_TOKEN_BUDGET", "4000"))
+# at most this many entries (jobs, projects, bullets) are kept across all sections (0 for no limit)
+RESUME_TOP_K = int(os.environ.get("RESUME_TOP_K", "0"))
+# sections whose title contains one of these are always sent whole
+RESUME_KEEP_SECTIONS = [title.strip().lower() for title in
+                        os.environ.get("RESUME_KEEP_SECTIONS", "education,skill,summary,objective").split(",")
+                        if title.strip()]
+
+SECTION_MACROS = ("section", "section*")
+LIST_ENVIRONMENTS = ("itemize", "enumerate", "description")
+
+# a span of the source that can be dropped as a whole: one job, project or bullet
+Entry = namedtuple("Entry", ["section", "start", "end", "text"])
+
+_WORD = re.compile(r"[a-z0-9][a-z0-9+#.]*[a-z0-9+#]|[a-z0-9]")
+_to_text = LatexNodes2Text()
+
+
+def estimate_tokens(text):
+    # about four characters per token for English text and LaTeX
+    return len(text) // 4 + 1
+
+
+def _node_text(latex):
+    try:
+        return _to_text.latex_to_text(latex)
+    except Exception:
+        return latex
+
+
+def _is_marker(node, kind):
+    if not isinstance(node, LatexMacroNode):
+        return False
+    name = node.macroname.lower()
+    if "list" in name or name.endswith(("start", "end")):
+        return False
+    return kind in name
+
+
+def _section_entries(latex, title, nodes, section_end):
+    """Split the body of one section into droppable entries.
+
+    Entries start at heading macros like `\\resumeSubheading` or `\\resumeProjectHeading` when the
+    section has any, otherwise at item macros like `\\resumeItem` or `\\item`, otherwise at the
+    `\\item`s of its top-level lists. Anything the entries don't cover stays in the resume.
+    """
+    for kind in ("heading", "item"):
+        starts = [node.pos for node in nodes if _is_marker(node, kind)]
+        if starts:
+            # the last entry ends where its surrounding list is closed, e.g. at \resumeSubHeadingListEnd
+            list_ends = [node.pos for node in nodes if isinstance(node, LatexMacroNode) and node.pos > starts[-1]
+                         and node.macroname.lower().endswith("end")]
+            ends = starts[1:] + [list_ends[-1] if list_ends else section_end]
+            return [Entry(title, start, end, _node_text(latex[start:end])) for start, end in zip(starts, ends)]
+
+    entries = []
+    for node in nodes:
+        if isinstance(node, LatexEnvironmentNode) and node.environmentname in LIST_ENVIRONMENTS:
+            starts = [child.pos for child in node.nodelist
+                      if isinstance(child, LatexMacroNode) and child.macroname == "item"]
+            if starts:
+                ends = starts[1:] + [latex.rfind("\\end", node.pos, node.pos + node.len)]
+                entries.extend(Entry(title, start, end, _node_text(latex[start:end]))
+                               for start, end in zip(starts, ends))
+    return entries
+
+
+def parse_entries(latex):
+    """Return the droppable entries of the resume, grouped by section, in document order.
+
+    Returns an empty list when the document can't be parsed, so it is sent unpruned.
+    """
+    parts = split_preamble(latex)
+    if parts is None:
+        return []
+    # only the body is parsed: preamble macros like \newcommand{\listStart}{\begin{itemize}} open
+    # environments they don't close, which throws the parser off for the rest of the document
+    offset = len(parts[0])
+    try:
+        nodes, _, _ = LatexWalker(latex[offset:], tolerant_parsing=True).get_latex_nodes()
+    except Exception:
+        return []
+    document = next((node for node in nodes if isinstance(node, LatexEnvironmentNode)
+                     and node.environmentname == "document"), None)
+    if document is None:
+        return []
+
+    source = latex[offset:]
+    body = document.nodelist
+    section_starts = [index for index, node in enumerate(body)
+                      if isinstance(node, LatexMacroNode) and node.macroname in SECTION_MACROS]
+    document_end = source.rfind("\\end", document.pos, document.pos + document.len)
+    sections = []
+    for number, index in enumerate(section_starts):
+        node = body[index]
+        title_arg = node.nodeargd.argnlist[-1] if node.nodeargd and node.nodeargd.argnlist else None
+        title = _node_text(source[title_arg.pos:title_arg.pos + title_arg.len]).strip() if title_arg else ""
+        if any(keep in title.lower() for keep in RESUME_KEEP_SECTIONS):
+            continue
+        next_index = section_starts[number + 1] if number + 1 < len(section_starts) else len(body)
+        section_end = body[next_index].pos if next_index < len(body) else document_end
+        sections.append(_section_entries(source, title, body[index + 1:next_index], section_end))
+    return [entry._replace(start=entry.start + offset, end=entry.end + offset)
+            for entries in sections for entry in entries]
+
+
+def tokenize(text):
+    return _WORD.findall(text.lower())
+
+
+def relevance_scores(texts, query):
+    """Cosine similarity of each text to `query` over TF-IDF weighted word counts."""
+    documents = [tokenize(text) for text in texts]
+    query_words = tokenize(query)
+    vocabulary = {}
+    for words in documents + [query_words]:
+        for word in words:
+            vocabulary.setdefault(word, len(vocabulary))
+    if not vocabulary:
+        return np.zeros(len(texts))
+
+    counts = np.zeros((len(documents) + 1, len(vocabulary)), dtype=np.float32)
+    for row, words in enumerate(documents + [query_words]):
+        np.add.at(counts[row], [vocabulary[word] for word in words], 1)
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(counts)) / (1 + document_frequency)) + 1
+    weights = np.log1p(counts) * idf
+    norms = np.linalg.norm(weights, axis=1)
+    norms[norms == 0] = 1
+    weights /= norms[:, None]
+    return weights[:-1] @ weights[-1]
+
+
+@lru_cache(maxsize=32)
+def prune_resume(latex, query, token_budget=RESUME_TOKEN_BUDGET, top_k=RESUME_TOP_K):
+    """Drop the entries of `latex` least relevant to `query` until it fits in `token_budget`.
+
+    The preamble, heading, section titles and the sections in RESUME_KEEP_SECTIONS are always kept,
+    as is the best entry of every section, so no list is left empty. The rest are added back in
+    order of relevance while they fit, up to `top_k` entries in total. Entries keep their original
+    order in the document. Returns `latex` unchanged when it already fits or can't be parsed.
+    """
+    if token_budget <= 0 or (estimate_tokens(latex) <= token_budget and top_k <= 0):
+        return latex
+    entries = parse_entries(latex)
+    if not entries:
+        return latex
+
+    scores = relevance_scores([f"{entry.section} {entry.text}" for entry in entries], query)
+    order = np.argsort(-scores, kind="stable")
+    sizes = [estimate_tokens(latex[entry.start:entry.end]) for entry in entries]
+    used = estimate_tokens(latex) - sum(sizes)
+
+    keep = set()
+    sections = set()
+    for index in order:
+        if entries[index].section not in sections:
+            sections.add(entries[index].section)
+            keep.add(index)
+            used += sizes[index]
+    for index in order:
+        if top_k > 0 and len(keep) >= top_k:
+            break
+        if index not in keep and used + sizes[index] <= token_budget:
+            keep.add(index)
+            used += sizes[index]
+
+    if len(keep) == len(entries):
+        return latex
+    parts = []
+    position = 0
+    for index, entry in enumerate(entries):
+        if index not in keep:
+            parts.append(latex[position:entry.start])
+            position = entry.end
+    parts.append(latex[position:])
+    return "".join(parts)
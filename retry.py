@@ -0,0 +1,294 @@
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import anthropic
+import openai
+
+from metrics import count
+
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "4"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "30"))
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "180"))
+LLM_PARSE_RETRIES = int(os.environ.get("LLM_PARSE_RETRIES", "1"))
+LLM_CIRCUIT_BREAKER = os.environ.get("LLM_CIRCUIT_BREAKER", "1") == "1"
+LLM_CIRCUIT_THRESHOLD = int(os.environ.get("LLM_CIRCUIT_THRESHOLD", "5"))
+LLM_CIRCUIT_COOLDOWN = float(os.environ.get("LLM_CIRCUIT_COOLDOWN", "60"))
+# comma separated provider:model routes tried, in order, after the selected model fails
+LLM_FALLBACK_ROUTES = os.environ.get("LLM_FALLBACK_ROUTES", "Claude:claude-3-5-sonnet-20240620,OpenAI:gpt-4o")
+
+RETRYABLE = "retryable"
+PARSE = "parse"
+FATAL = "fatal"
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+Route = namedtuple("Route", ["provider", "model"])
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, route, seconds):
+        self.route = route
+        super().__init__(f"{route.provider} {route.model} was skipped after repeated failures, it will be tried "
+                         f"again in {seconds:.0f}s")
+
+
+class RetryError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+        failures = [error for _, error in errors if not isinstance(error, CircuitOpenError)]
+        skipped = [str(error) for _, error in errors if isinstance(error, CircuitOpenError)]
+        message = f"All attempts failed. Last error: {failures[-1]}" if failures else "No model could be called."
+        if skipped:
+            message += " " + ". ".join(skipped) + "."
+        super().__init__(message)
+
+
+def classify(error):
+    """Sort an exception into RETRYABLE (worth another try), PARSE (bad model output) or FATAL."""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return RETRYABLE if status in RETRYABLE_STATUS or status >= 500 else FATAL
+    if isinstance(error, (openai.APIConnectionError, anthropic.APIConnectionError, TimeoutError, ConnectionError)):
+        return RETRYABLE
+    # transport errors raised in the middle of a stream are not wrapped by the SDKs
+    if type(error).__module__.split(".")[0] in ("httpx", "httpx2", "httpcore", "httpcore2"):
+        return RETRYABLE
+    if isinstance(error, (ValueError, KeyError, IndexError)):
+        return PARSE
+    return FATAL
+
+
+def _parse_duration(value):
+    # OpenAI rate limit resets look like "1s", "250ms" or "6m0s"
+    total = 0.0
+    number = ""
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char.isdigit() or char == ".":
+            number += char
+        elif value.startswith("ms", index):
+            total += float(number or 0) / 1000
+            number = ""
+            index += 1
+        elif char in "hms":
+            total += float(number or 0) * {"h": 3600, "m": 60, "s": 1}[char]
+            number = ""
+        else:
+            return None
+        index += 1
+    return total if not number else total + float(number)
+
+
+# (remaining, reset) headers of the providers' rate limit buckets
+OPENAI_BUCKETS = [("x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+                  ("x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens")]
+ANTHROPIC_BUCKETS = [(f"anthropic-ratelimit-{bucket}-remaining", f"anthropic-ratelimit-{bucket}-reset")
+                     for bucket in ("requests", "tokens", "input-tokens", "output-tokens")]
+
+
+def retry_after(error):
+    """Seconds the provider asked us to wait before retrying, taken from the error's response headers.
+
+    `retry-after` counts for any error. The rate limit reset times only count for a 429, and only for
+    the buckets that are used up; the others say nothing about when a retry can go through.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(headers["retry-after"]) -
+                                 datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    if getattr(error, "status_code", None) != 429:
+        return None
+
+    waits = []
+    for remaining, reset in OPENAI_BUCKETS:
+        if headers.get(remaining) == "0" and headers.get(reset):
+            wait = _parse_duration(headers[reset])
+            if wait is not None:
+                waits.append(wait)
+    for remaining, reset in ANTHROPIC_BUCKETS:
+        if headers.get(remaining) == "0" and headers.get(reset):
+            try:
+                reset_at = datetime.fromisoformat(headers[reset].replace("Z", "+00:00"))
+                waits.append(max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds()))
+            except ValueError:
+                pass
+    return max(waits) if waits else None
+
+
+class CircuitBreaker:
+    """Stops sending requests to a route after `threshold` failures in a row, for `cooldown` seconds.
+
+    After the cooldown one request is let through again; a success closes the circuit. Only transient
+    failures should be recorded: the breaker is shared by every user, and one user's bad API key says
+    nothing about the route.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened_at = {}
+        self._lock = threading.Lock()
+
+    def allow(self, route):
+        with self._lock:
+            opened_at = self._opened_at.get(route)
+            return opened_at is None or time.monotonic() - opened_at >= self.cooldown
+
+    def retry_in(self, route):
+        """Seconds until an open circuit lets a request through again."""
+        with self._lock:
+            opened_at = self._opened_at.get(route)
+            return 0.0 if opened_at is None else max(0.0, opened_at + self.cooldown - time.monotonic())
+
+    def record_success(self, route):
+        with self._lock:
+            self._failures.pop(route, None)
+            self._opened_at.pop(route, None)
+
+    def record_failure(self, route):
+        with self._lock:
+            self._failures[route] = self._failures.get(route, 0) + 1
+            if self._failures[route] >= self.threshold:
+                self._opened_at[route] = time.monotonic()
+
+
+breaker = CircuitBreaker(LLM_CIRCUIT_THRESHOLD, LLM_CIRCUIT_COOLDOWN)
+
+
+class RouteStats:
+    """Recent latency and error rate of every route per task, as exponentially weighted averages.
+
+    Each attempt counts, so a model that needs retries shows up as both slower and less reliable.
+    """
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, task, seconds, ok):
+        with self._lock:
+            latency, error_rate, samples = self._stats.get((route, task), (None, None, 0))
+            outcome = 0.0 if ok else 1.0
+            error_rate = outcome if error_rate is None else error_rate + self.smoothing * (outcome - error_rate)
+            # only successful calls say how long the route takes
+            if ok:
+                latency = seconds if latency is None else latency + self.smoothing * (seconds - latency)
+            self._stats[(route, task)] = (latency, error_rate, samples + 1)
+
+    def get(self, route, task):
+        """`(latency, error_rate, samples)`, or None before the first attempt; latency is None before the
+        first success."""
+        with self._lock:
+            return self._stats.get((route, task))
+
+
+stats = RouteStats()
+
+
+def backoff_delay(error, attempt, base=LLM_BACKOFF_BASE, maximum=LLM_BACKOFF_MAX):
+    """Exponential backoff with full jitter, or the provider's own wait hint when it sent one.
+
+    Neither is longer than `maximum`; a longer hint would usually overrun the deadline and give up the route.
+    """
+    hinted = retry_after(error)
+    if hinted is not None:
+        return min(maximum, hinted) + random.uniform(0, base / 4)
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def routes_for(provider, model, fallbacks=LLM_FALLBACK_ROUTES):
+    """The selected route followed by the configured fallback routes, without duplicates."""
+    routes = [Route(provider, model)]
+    for entry in fallbacks.split(","):
+        if ":" not in entry:
+            continue
+        route = Route(*(part.strip() for part in entry.split(":", 1)))
+        if route not in routes:
+            routes.append(route)
+    return routes
+
+
+def call_with_retry(routes, attempt, on_retry=None, on_failover=None, max_attempts=LLM_MAX_ATTEMPTS,
+                    deadline=LLM_DEADLINE, parse_retries=LLM_PARSE_RETRIES, task=None):
+    """Call `attempt(route)` until it succeeds and return `(route, result)`.
+
+    Transient errors (rate limits, overload, timeouts, 5xx) are retried with backoff. Bad model output
+    is retried `parse_retries` times. Errors a retry can't fix, like a bad API key, move straight on to
+    the next route. No retry is started if its wait would overrun the `deadline` in seconds. Raises
+    `RetryError` once every route has failed. The time and outcome of every attempt, fatal errors aside,
+    go into `stats` under `task`, for the router.
+    """
+    give_up_at = time.monotonic() + deadline
+    errors = []
+    for route_index, route in enumerate(routes):
+        if LLM_CIRCUIT_BREAKER and not breaker.allow(route):
+            errors.append((route, CircuitOpenError(route, breaker.retry_in(route))))
+            continue
+        parse_failures = 0
+        for attempt_number in range(max_attempts):
+            started = time.monotonic()
+            try:
+                result = attempt(route)
+            except Exception as e:
+                errors.append((route, e))
+                kind = classify(e)
+                # like the breaker, the stats are shared; a fatal error is the caller's problem, not the route's
+                if kind != FATAL:
+                    stats.record(route, task, time.monotonic() - started, ok=False)
+                count("llm_attempts_total", help="Model calls by outcome", provider=route.provider,
+                      model=route.model, outcome=kind)
+                if kind == PARSE:
+                    parse_failures += 1
+                    if parse_failures > parse_retries:
+                        break
+                    delay = 0
+                elif kind == FATAL:
+                    break
+                else:
+                    breaker.record_failure(route)
+                    if LLM_CIRCUIT_BREAKER and not breaker.allow(route):
+                        break
+                    delay = backoff_delay(e, attempt_number)
+                if attempt_number + 1 == max_attempts or time.monotonic() + delay > give_up_at:
+                    break
+                if on_retry is not None:
+                    on_retry(route, e, delay)
+                time.sleep(delay)
+            else:
+                stats.record(route, task, time.monotonic() - started, ok=True)
+                breaker.record_success(route)
+                count("llm_attempts_total", help="Model calls by outcome", provider=route.provider,
+                      model=route.model, outcome="ok")
+                return route, result
+
+        if time.monotonic() >= give_up_at:
+            break
+        if errors and route_index + 1 < len(routes):
+            count("llm_failovers_total", help="Requests moved on to a fallback model", provider=route.provider,
+                  model=route.model)
+            if on_failover is not None:
+                on_failover(route, errors[-1][1])
+    raise RetryError(errors)
@@ -0,0 +1,110 @@
+import os
+from collections import namedtuple
+
+from metrics import count
+from retry import LLM_CIRCUIT_BREAKER, Route, breaker, stats
+
+# the most a single request may be expected to cost in dollars, and to take in seconds
+ROUTER_MAX_COST = float(os.environ.get("ROUTER_MAX_COST", "0.10"))
+ROUTER_MAX_LATENCY = float(os.environ.get("ROUTER_MAX_LATENCY", "60"))
+# what a second of waiting is worth in dollars, when trading a faster model against a cheaper one
+ROUTER_SECOND_PRICE = float(os.environ.get("ROUTER_SECOND_PRICE", "0.001"))
+# models failing more often than this recently are only used as a fallback
+ROUTER_MAX_ERROR_RATE = float(os.environ.get("ROUTER_MAX_ERROR_RATE", "0.3"))
+# how many models a request may go through, the chosen one included
+ROUTER_ROUTES = int(os.environ.get("ROUTER_ROUTES", "3"))
+
+# prices in dollars per million tokens; quality 3 can rewrite a whole resume, 2 make targeted edits, 1 chat
+ModelProfile = namedtuple("ModelProfile", ["provider", "input_price", "output_price", "quality",
+                                           "tokens_per_second", "first_token"])
+MODEL_PROFILES = {
+    "claude-3-5-sonnet-20240620": ModelProfile("Claude", 3.0, 15.0, 3, 60, 1.0),
+    "claude-3-opus-20240229": ModelProfile("Claude", 15.0, 75.0, 3, 25, 2.0),
+    "claude-3-haiku-20240307": ModelProfile("Claude", 0.25, 1.25, 1, 120, 0.5),
+    "gpt-4o": ModelProfile("OpenAI", 5.0, 15.0, 3, 80, 0.7),
+    "gpt-4-turbo": ModelProfile("OpenAI", 10.0, 30.0, 3, 35, 1.0),
+    "gpt-4": ModelProfile("OpenAI", 30.0, 60.0, 3, 20, 1.0),
+    "gpt-4o-mini": ModelProfile("OpenAI", 0.15, 0.6, 2, 100, 0.5),
+    "gpt-3.5-turbo": ModelProfile("OpenAI", 0.5, 1.5, 1, 100, 0.4),
+}
+
+# the quality a task needs, and the output it produces if the caller doesn't say
+TaskProfile = namedtuple("TaskProfile", ["quality", "output_tokens"])
+TASKS = {
+    "resume": TaskProfile(3, 3000),
+    "edits": TaskProfile(2, 1200),
+    "repair": TaskProfile(2, 800),
+    "chat": TaskProfile(1, 700),
+    "summary": TaskProfile(1, 400),
+}
+
+# one model the router considered: what it would cost and take, and why it was or wasn't picked
+Estimate = namedtuple("Estimate", ["route", "cost", "latency", "error_rate", "score", "reason"])
+Decision = namedtuple("Decision", ["task", "routes", "estimates"])
+
+
+def estimate(route, profile, task, input_tokens, output_tokens):
+    """Expected cost and latency of `route` for one request, from recent calls when there are any."""
+    cost = (input_tokens * profile.input_price + output_tokens * profile.output_price) / 1_000_000
+    latency, error_rate, _ = stats.get(route, task) or (None, None, 0)
+    if latency is None:
+        latency = profile.first_token + output_tokens / profile.tokens_per_second
+    error_rate = error_rate or 0.0
+    # a failed call is paid for in time and usually money too, and then has to be made again
+    score = (cost + ROUTER_SECOND_PRICE * latency) / max(0.05, 1 - error_rate)
+    return cost, latency, error_rate, score
+
+
+def choose(task, input_tokens, output_tokens=None, providers=("OpenAI", "Claude"), profiles=None):
+    """Pick the models for one request of `task` and return a `Decision`.
+
+    Models good enough for the task whose expected cost and latency fit the budget come first, cheapest
+    (counting waiting time at ROUTER_SECOND_PRICE) first. When none fits, the best of the rest are used
+    so the request still goes out. Only models of the given `providers` are considered.
+    """
+    profiles = MODEL_PROFILES if profiles is None else profiles
+    task_profile = TASKS[task]
+    output_tokens = task_profile.output_tokens if output_tokens is None else output_tokens
+    preferred = []
+    fallback = []
+    for model, profile in profiles.items():
+        if profile.provider not in providers:
+            continue
+        route = Route(profile.provider, model)
+        cost, latency, error_rate, score = estimate(route, profile, task, input_tokens, output_tokens)
+        if profile.quality < task_profile.quality:
+            reason = "not strong enough"
+        elif cost > ROUTER_MAX_COST:
+            reason = "over the cost budget"
+        elif latency > ROUTER_MAX_LATENCY:
+            reason = "over the latency budget"
+        elif error_rate > ROUTER_MAX_ERROR_RATE:
+            reason = "failing too often"
+        elif LLM_CIRCUIT_BREAKER and not breaker.allow(route):
+            reason = "circuit open"
+        else:
+            reason = None
+        entry = Estimate(route, cost, latency, error_rate, score, reason)
+        if reason is None:
+            preferred.append(entry)
+        elif profile.quality >= task_profile.quality:
+            fallback.append(entry)
+    preferred.sort(key=lambda entry: entry.score)
+    fallback.sort(key=lambda entry: entry.score)
+    estimates = preferred + fallback
+    decision = Decision(task, [entry.route for entry in estimates[:ROUTER_ROUTES]], estimates)
+    if decision.routes:
+        chosen = decision.routes[0]
+        count("router_decisions_total", help="Requests routed per task and model", task=task,
+              provider=chosen.provider, model=chosen.model, within_budget="1" if preferred else "0")
+    return decision
+
+
+def describe(decision):
+    """One line on what was picked and why, for the job log."""
+    if not decision.estimates:
+        return f"No model available for {decision.task}."
+    chosen = decision.estimates[0]
+    note = f", {chosen.reason}, nothing fit the budget" if chosen.reason else ""
+    return (f"Using {chosen.route.model} for {decision.task}: about ${chosen.cost:.4f} and "
+            f"{chosen.latency:.0f}s{note}.")
@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from json_extract import TruncatedError, extract_json
+
+RESPONSE = json.dumps({"name": "cl", "cover_letter": "Dear hiring manager",
+                       "resume": "\\documentclass{article}\n\\begin{document}\n" + "Built things. " * 100})
+KEYS = ("name", "cover_letter", "resume")
+
+
+def test_latex_escapes_are_kept():
+    assert extract_json('{"resume": "\\textbf{Go} \\section{Skills}"}')["resume"] == "\\textbf{Go} \\section{Skills}"
+
+
+def test_cut_off_in_required_field_raises():
+    with pytest.raises(TruncatedError):
+        extract_json(RESPONSE[:len(RESPONSE) * 3 // 5], KEYS)
+
+
+def test_cut_off_in_nested_field_raises():
+    with pytest.raises(TruncatedError):
+        extract_json('{"edits": [{"section": "Skills", "latex": "Go', ("edits",))
+
+
+def test_missing_closing_brace_only_is_accepted():
+    assert extract_json(RESPONSE[:-1], KEYS) == json.loads(RESPONSE)
+
+
+def test_cut_off_is_repaired_without_required_keys():
+    assert set(extract_json(RESPONSE[:len(RESPONSE) * 3 // 5])) == set(KEYS)
@@ -0,0 +1,31 @@
+from latex_lint import lint, repair
+
+PREAMBLE = """\\documentclass{article}
+\\usepackage{hyperref}
+\\newcommand{\\resumeItemListStart}{\\begin{itemize}}
+\\newcommand{\\resumeItemListEnd}{\\end{itemize}}
+\\newcommand{\\resumeItem}[1]{\\item\\small{#1}}
+"""
+
+
+def test_document_cut_off_at_the_end_is_repaired():
+    latex = PREAMBLE + "\\begin{document}\n\\section{Skills}\n\\begin{itemize}\n\\item \\textbf{a"
+    repaired = repair(latex, lint(latex, PREAMBLE))
+    assert repaired.endswith("\\textbf{a}\\end{itemize}\n\n\\end{document}\n")
+    assert lint(repaired, PREAMBLE) == []
+
+
+def test_environments_opened_by_preamble_macros_are_checked():
+    latex = (PREAMBLE + "\\begin{document}\n\\section{Experience}\n\\resumeItemListStart\n\\resumeItem{Go}\n"
+             "\\section{Skills}\nPython\n\\end{document}\n")
+    issues = lint(latex, PREAMBLE)
+    assert [issue.kind for issue in issues] == ["unclosed_environment"]
+    assert lint(repair(latex, issues), PREAMBLE) == []
+    closed = latex.replace("\\section{Skills}", "\\resumeItemListEnd\n\\section{Skills}")
+    assert lint(closed, PREAMBLE) == []
+
+
+def test_percent_in_urls_is_not_a_comment():
+    latex = (PREAMBLE + "\\begin{document}\n\\href{https://example.com/a%20b}{site} \\url{https://x.org/%7Eme}\n"
+             "\\end{document}\n")
+    assert lint(latex, PREAMBLE) == []
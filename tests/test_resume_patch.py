@@ -0,0 +1,37 @@
+import pytest
+
+from resume_patch import PatchError, apply_edits
+
+RESUME = """\\documentclass{article}
+\\begin{document}
+\\section{Skills}
+Python, SQL
+\\section{Experience}
+Engineer at Initech
+\\end{document}
+"""
+
+
+def test_replaces_section_and_snippet():
+    patched = apply_edits(RESUME, [{"section": "skills", "latex": "Go, Rust"},
+                                   {"find": "Engineer  at\nInitech", "replace": "Lead at Initech"}])
+    assert "Go, Rust" in patched and "Python" not in patched
+    assert "Lead at Initech" in patched
+
+
+@pytest.mark.parametrize("edit", [
+    {"op": "replace_section", "title": "X", "body": None},
+    {"section": "Skills", "latex": None},
+    {"section": None, "latex": "Go"},
+    {"find": "Python", "replace": None},
+    {"find": ["Python"], "replace": "Go"},
+    "replace everything",
+])
+def test_malformed_edit_raises_patch_error(edit):
+    with pytest.raises(PatchError):
+        apply_edits(RESUME, [edit])
+
+
+def test_edits_must_be_a_list():
+    with pytest.raises(PatchError):
+        apply_edits(RESUME, None)